@@ -0,0 +1,53 @@
+import io
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.polymerize import get_atom_count, get_monomer_template, get_polymer_skeleton
+from utils.polymer_constant import monomer_data_dir, pdb_dict, connection_point_dict
+from utils.structure_io import write_pdb
+
+# Emission scaling
+'''
+Times the removal mask (get_polymer_skeleton) and the PDB emission of the kept atoms for chains of about
+1e4, 1e5 and 1e6 atoms. Both used to grow with atoms x removed atoms, so the time per atom of the largest
+chain is checked against the smallest one. Run as: python benchmarks/bench_emit.py
+'''
+bench_atom_count_list = [10**4, 10**5, 10**6]
+bench_repeat = 3
+max_time_per_atom_ratio = 3.0  # largest over smallest chain, linear scaling stays close to 1
+
+def get_best_time(function, repeat: int = bench_repeat) -> float:
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_emit(monomer_key: str = '2') -> list:
+    with open(os.path.join(monomer_data_dir, pdb_dict[monomer_key])) as handle:
+        monomer = get_monomer_template(handle.read(), connection_point_dict[monomer_key])
+
+    result_list = []
+    for atom_count in bench_atom_count_list:
+        monomer_count = atom_count // get_atom_count(monomer)
+        polymer, polymer_remove_atom_mask = get_polymer_skeleton(monomer, monomer_count)
+        polymer['coord'][:] = 0.0
+        mask_time = get_best_time(lambda: get_polymer_skeleton(monomer, monomer_count))
+        emit_time = get_best_time(lambda: write_pdb(io.BytesIO(), polymer, np.flatnonzero(~polymer_remove_atom_mask)))
+        result_list.append((get_atom_count(polymer), mask_time, emit_time))
+        print(f'{get_atom_count(polymer):9d} atoms: mask {mask_time:8.4f} s, emit {emit_time:8.4f} s')
+    return result_list
+
+if __name__ == '__main__':
+    result_list = bench_emit()
+    atom_count = np.array([result[0] for result in result_list])
+    for icol, name in [(1, 'mask'), (2, 'emit')]:
+        time_per_atom = np.array([result[icol] for result in result_list]) / atom_count
+        ratio = time_per_atom[-1] / time_per_atom[0]
+        print(f'{name}: time per atom at {atom_count[-1]} atoms is {ratio:.2f} x the one at {atom_count[0]} atoms')
+        assert ratio < max_time_per_atom_ratio, f'{name} does not scale linearly with the atom count'
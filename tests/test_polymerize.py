@@ -0,0 +1,81 @@
+import io
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# utils imports aiida at module level (polymer_constant, structure_io, polymerize)
+pytest.importorskip('aiida')
+
+from utils.polymerize import get_monomer_template, build_polymer_structure, extend_polymer_structure, get_copolymer_sequence
+from utils.polymer_constant import monomer_data_dir, pdb_dict, connection_point_dict
+from utils.structure_io import select_structure, write_pdb
+
+# Stepwise baselines
+'''
+The stepwise PDB of every monomer in monomer_data/ is compared character by character with a stored baseline,
+so changes to get_monomer_template or place_monomer_stepwise cannot move a single atom unnoticed.
+Run this file as a script to write the baselines again after an intended change.
+'''
+baseline_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'stepwise')
+baseline_monomer_count_list = [1, 2, 10, 50]
+monomer_key_dict = {pdb_fname: key for key, pdb_fname in pdb_dict.items()}
+monomer_pdb_fname_list = sorted(fname for fname in os.listdir(monomer_data_dir) if fname.endswith('.pdb'))
+
+def get_stepwise_pdb(pdb_fname: str, monomer_count: int) -> str:
+    with open(os.path.join(monomer_data_dir, pdb_fname)) as handle:
+        monomer = get_monomer_template(handle.read(), connection_point_dict[monomer_key_dict[pdb_fname]])
+    polymer, polymer_remove_atom_mask = build_polymer_structure(monomer, monomer_count, 'stepwise')
+    handle = io.BytesIO()
+    write_pdb(handle, polymer, np.flatnonzero(~polymer_remove_atom_mask))
+    return handle.getvalue().decode()
+
+def get_baseline_fname(pdb_fname: str, monomer_count: int) -> str:
+    return os.path.join(baseline_dir, f'{os.path.splitext(pdb_fname)[0]}_{monomer_count}.pdb')
+
+@pytest.mark.parametrize('monomer_count', baseline_monomer_count_list)
+@pytest.mark.parametrize('pdb_fname', monomer_pdb_fname_list)
+def test_stepwise_baseline(pdb_fname, monomer_count):
+    with open(get_baseline_fname(pdb_fname, monomer_count)) as handle:
+        assert get_stepwise_pdb(pdb_fname, monomer_count) == handle.read()
+
+# Random-walk extension
+'''
+Extending a random-walk chain must not give up on valid input, and keeps the atoms before the old end in place.
+'''
+extension_seed_list = list(range(8))
+
+@pytest.mark.parametrize('seed', extension_seed_list)
+@pytest.mark.parametrize('monomer_key', ['2', '3'])
+def test_random_walk_extension(monomer_key, seed):
+    with open(os.path.join(monomer_data_dir, pdb_dict[monomer_key])) as handle:
+        monomer = get_monomer_template(handle.read(), connection_point_dict[monomer_key])
+    polymer, polymer_remove_atom_mask = build_polymer_structure(monomer, 10, 'random_walk', seed)
+    polymer = select_structure(polymer, np.flatnonzero(~polymer_remove_atom_mask))
+    extension, extension_remove_atom_mask = extend_polymer_structure(polymer, monomer, 20, 'random_walk', seed + 100)
+    fresh, fresh_remove_atom_mask = build_polymer_structure(monomer, 20, 'random_walk', seed)
+    assert np.array_equal(extension_remove_atom_mask, fresh_remove_atom_mask)
+    extension = select_structure(extension, np.flatnonzero(~extension_remove_atom_mask))
+    assert np.all(np.isfinite(extension['coord']))
+    kept_mask = polymer['residue_seq_num'] < 8
+    assert np.allclose(extension['coord'][:np.count_nonzero(kept_mask)], polymer['coord'][kept_mask], atol=1e-3)
+
+# Copolymer sequences
+@pytest.mark.parametrize('sequence_type', ['block', 'alternating', 'random'])
+def test_copolymer_sequence_needs_monomer_count(sequence_type):
+    with pytest.raises(ValueError):
+        get_copolymer_sequence([1, 2], None, sequence_type)
+
+def test_alternating_sequence_ratio():
+    assert get_copolymer_sequence([1, 2], 5, 'alternating', [3, 3]).tolist() == [1, 2, 1, 2, 1]
+    with pytest.raises(ValueError):
+        get_copolymer_sequence([1, 2], 5, 'alternating', [1, 2])
+
+if __name__ == '__main__':
+    os.makedirs(baseline_dir, exist_ok=True)
+    for pdb_fname in monomer_pdb_fname_list:
+        for monomer_count in baseline_monomer_count_list:
+            with open(get_baseline_fname(pdb_fname, monomer_count), 'w') as handle:
+                handle.write(get_stepwise_pdb(pdb_fname, monomer_count))
@@ -0,0 +1,38 @@
+import io
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# utils imports aiida at module level (structure_io)
+pytest.importorskip('aiida')
+
+from utils.structure_io import get_buffer, parse_pdb, write_pdb, write_gro
+
+# Coordinate range of the text formats
+'''
+Coordinates wider than the %8.3f columns would shift the rest of the line, so writing them has to fail
+instead of producing a file parse_pdb cannot read back.
+'''
+def get_line_structure(x_list: list) -> dict:
+    atom_count = len(x_list)
+    return {'atom_name_table': np.array(['C']), 'atom_name': np.zeros(atom_count, dtype=np.int64),
+            'residue_name_table': np.array(['PE1']), 'residue_name': np.zeros(atom_count, dtype=np.int64),
+            'element_table': np.array(['C']), 'element': np.zeros(atom_count, dtype=np.int64),
+            'residue_seq_num': np.arange(atom_count),
+            'coord': np.stack([np.asarray(x_list, dtype=np.float64), np.zeros(atom_count), np.zeros(atom_count)], axis=1)}
+
+def test_pdb_round_trip_at_range_limit():
+    structure = get_line_structure([-999.999, 0.0, 9999.999])
+    handle = io.BytesIO()
+    write_pdb(handle, structure)
+    assert np.allclose(parse_pdb(get_buffer(handle.getvalue().decode()))['coord'], structure['coord'])
+
+@pytest.mark.parametrize('x', [-1000.0, 10000.0])
+def test_pdb_coordinate_out_of_range(x):
+    with pytest.raises(ValueError):
+        write_pdb(io.BytesIO(), get_line_structure([0.0, x]))
+    # the .gro columns are in nm and take ten times the range
+    write_gro(io.BytesIO(), get_line_structure([0.0, x]))
@@ -0,0 +1,151 @@
+import itertools
+import numpy as np
+
+# Spatial hash of atom coordinates
+'''
+Atoms are binned into cubic cells that are at least as large as the cutoff, so an overlap query for a
+candidate atom only looks at the 27 cells around it instead of every stored atom. Atoms are added
+incrementally, e.g. monomer by monomer while a chain grows or molecule by molecule while a box is packed.
+Without a box the cells live in a dict keyed by the packed cell index. With a box the cells wrap around,
+are stored as one dense (cell, slot, xyz) array of wrapped coordinates and a query is a single gather.
+'''
+neighbor_offset = np.array(list(itertools.product([-1, 0, 1], repeat=3)))
+cell_key_base = 2**21  # cell indices are packed into one int64 key, 21 bits per axis
+max_pair_count = 2**20  # candidate-neighbour pairs per distance block
+initial_cell_capacity = 8
+
+def get_cell_list(cutoff: float, box: np.array = None) -> dict:
+    cell_list = {'cutoff': float(cutoff), 'box': None, 'atom_count': 0}
+    if box is None:
+        cell_list['cell_size'] = np.full(3, float(cutoff))
+        cell_list['cell'] = {}
+    else:
+        box = np.broadcast_to(np.asarray(box, dtype=np.float64), (3,)).copy()
+        cell_count = np.maximum(np.floor(box / cutoff).astype(np.int64), 1)
+        cell_list['box'] = box
+        cell_list['cell_count'] = cell_count
+        cell_list['cell_size'] = box / cell_count
+        # empty slots are at infinity so they never overlap
+        cell_list['cell_coord'] = np.full((int(np.prod(cell_count)), initial_cell_capacity, 3), np.inf)
+        cell_list['cell_atom_count'] = np.zeros(int(np.prod(cell_count)), dtype=np.int64)
+    return cell_list
+
+def wrap_coord(cell_list: dict, coord: np.array) -> np.array:
+    coord = coord % cell_list['box']
+    coord[coord >= cell_list['box']] = 0.0  # -1e-17 % box rounds to box
+    return coord
+
+def get_cell_index(cell_list: dict, coord: np.array) -> np.array:
+    # coordinates are expected to be wrapped into the box when there is one
+    cell_index = np.floor(coord / cell_list['cell_size']).astype(np.int64)
+    if cell_list['box'] is not None:
+        cell_index = np.minimum(cell_index, cell_list['cell_count'] - 1)
+    return cell_index
+
+def get_cell_key(cell_list: dict, cell_index: np.array) -> np.array:
+    if cell_list['box'] is not None:
+        cell_count = cell_list['cell_count']
+        cell_index = cell_index % cell_count
+        return (cell_index[..., 0] * cell_count[1] + cell_index[..., 1]) * cell_count[2] + cell_index[..., 2]
+    cell_index = cell_index + cell_key_base // 2
+    return (cell_index[..., 0] * cell_key_base + cell_index[..., 1]) * cell_key_base + cell_index[..., 2]
+
+def group_by_cell(cell_list: dict, coord: np.array):
+    # (cell key, atom index) for every occupied cell
+    cell_key = get_cell_key(cell_list, get_cell_index(cell_list, coord))
+    order = np.argsort(cell_key, kind='stable')
+    unique_key, start = np.unique(cell_key[order], return_index=True)
+    return zip(unique_key.tolist(), np.split(order, start[1:]))
+
+def get_cell_slot(cell_list: dict, cell_key: np.array) -> np.array:
+    # slot of every new atom behind the atoms already in its cell
+    order = np.argsort(cell_key, kind='stable')
+    sorted_key = cell_key[order]
+    group_start = np.flatnonzero(np.concatenate([[True], sorted_key[1:] != sorted_key[:-1]]))
+    rank = np.arange(len(order)) - np.repeat(group_start, np.diff(np.append(group_start, len(order))))
+    slot = np.empty(len(order), dtype=np.int64)
+    slot[order] = cell_list['cell_atom_count'][sorted_key] + rank
+    return slot
+
+def add_cell_atom(cell_list: dict, coord: np.array):
+    coord = np.asarray(coord, dtype=np.float64).reshape(-1, 3)
+    if len(coord) == 0:
+        return
+    cell_list['atom_count'] += len(coord)
+    if cell_list['box'] is None:
+        for key, atom_index in group_by_cell(cell_list, coord):
+            cell_list['cell'].setdefault(key, []).append(coord[atom_index])
+        return
+
+    coord = wrap_coord(cell_list, coord)
+    cell_key = get_cell_key(cell_list, get_cell_index(cell_list, coord))
+    slot = get_cell_slot(cell_list, cell_key)
+    capacity = cell_list['cell_coord'].shape[1]
+    if slot.max() >= capacity:
+        new_capacity = max(2 * capacity, int(slot.max()) + 1)
+        cell_coord = np.full((len(cell_list['cell_coord']), new_capacity, 3), np.inf)
+        cell_coord[:, :capacity] = cell_list['cell_coord']
+        cell_list['cell_coord'] = cell_coord
+    cell_list['cell_coord'][cell_key, slot] = coord
+    cell_list['cell_atom_count'] += np.bincount(cell_key, minlength=len(cell_list['cell_atom_count']))
+
+def pop_cell_atom(cell_list: dict, coord: np.array):
+    # undo the last add_cell_atom call made with the same coordinates
+    coord = np.asarray(coord, dtype=np.float64).reshape(-1, 3)
+    if len(coord) == 0:
+        return
+    cell_list['atom_count'] -= len(coord)
+    if cell_list['box'] is None:
+        for key, _ in group_by_cell(cell_list, coord):
+            cell_list['cell'][key].pop()
+            if len(cell_list['cell'][key]) == 0:
+                del cell_list['cell'][key]
+        return
+
+    cell_key = get_cell_key(cell_list, get_cell_index(cell_list, wrap_coord(cell_list, coord)))
+    cell_list['cell_atom_count'] -= np.bincount(cell_key, minlength=len(cell_list['cell_atom_count']))
+    cell_list['cell_coord'][cell_key, get_cell_slot(cell_list, cell_key)] = np.inf
+
+def get_neighbor_coord(cell_list: dict, cell_index: np.array) -> np.array:
+    # stored atoms in the cells around any of cell_index
+    neighbor_key = np.unique(get_cell_key(cell_list, cell_index[:, None, :] + neighbor_offset))
+    chunk_list = [chunk for key in neighbor_key.tolist() for chunk in cell_list['cell'].get(key, ())]
+    return np.concatenate(chunk_list) if len(chunk_list) > 0 else np.empty((0, 3))
+
+def find_overlap_periodic(cell_list: dict, coord: np.array, cutoff: float) -> np.array:
+    # gather the 27 neighbour cells of every atom at once; the image shift follows from the wrapped cell index
+    coord = wrap_coord(cell_list, coord)
+    neighbor_index = get_cell_index(cell_list, coord)[:, None, :] + neighbor_offset
+    shift = np.floor_divide(neighbor_index, cell_list['cell_count']) * cell_list['box']
+    neighbor_coord = cell_list['cell_coord'][get_cell_key(cell_list, neighbor_index)] + shift[:, :, None, :]
+    delta = coord[:, None, None, :] - neighbor_coord
+    return (np.einsum('ankx,ankx->ank', delta, delta) < cutoff**2).any(axis=(1, 2))
+
+def find_overlap(cell_list: dict, coord: np.array, cutoff: float = None) -> np.array:
+    # True for every candidate atom closer than cutoff to a stored atom
+    cutoff = cell_list['cutoff'] if cutoff is None else min(cutoff, cell_list['cutoff'])
+    coord = np.asarray(coord, dtype=np.float64).reshape(-1, 3)
+    overlap = np.zeros(len(coord), dtype=bool)
+    if cell_list['atom_count'] == 0 or len(coord) == 0:
+        return overlap
+
+    if cell_list['box'] is not None:
+        block_size = max(max_pair_count // (27 * cell_list['cell_coord'].shape[1]), 1)
+        for start in range(0, len(coord), block_size):
+            overlap[start:start + block_size] = find_overlap_periodic(cell_list, coord[start:start + block_size], cutoff)
+        return overlap
+
+    cell_index = get_cell_index(cell_list, coord)
+    # small candidates (a monomer) in one block, large ones cell by cell
+    if len(coord) * min(cell_list['atom_count'], 27 * len(coord)) <= max_pair_count:
+        atom_group = [(np.unique(cell_index, axis=0), np.arange(len(coord)))]
+    else:
+        atom_group = [(cell_index[atom_index[:1]], atom_index) for _, atom_index in group_by_cell(cell_list, coord)]
+
+    for group_cell_index, atom_index in atom_group:
+        neighbor_coord = get_neighbor_coord(cell_list, group_cell_index)
+        if len(neighbor_coord) == 0:
+            continue
+        delta = coord[atom_index, None, :] - neighbor_coord[None, :, :]
+        overlap[atom_index] = np.einsum('abi,abi->ab', delta, delta).min(axis=1) < cutoff**2
+    return overlap
@@ -1,13 +1,22 @@
+import re
+import time
+import numpy as np
+
 # aiida packages
 from aiida.orm import Int, Float, Bool, Str, List, SinglefileData
 from aiida.engine import calcfunction
+from aiida_shell import launch_shell_job
+
+from utils.structure_io import read_structure_singlefile, get_structure_singlefile, concatenate_structure
+from utils.cell_list import get_cell_list, add_cell_atom, find_overlap
+from utils.mdp_builder import get_mdp_parameters, format_mdp, parse_mdp
 
 @calcfunction
-def calc_simulation_box_length(molecular_weight_polymer: Float, polymer_count: Int) -> Float:
+def calc_simulation_box_length(molecular_weight_polymer: Float, polymer_count: Int, density: Float = None) -> Float:
     molecular_weight = molecular_weight_polymer.value * polymer_count.value
     
-    # Default density (0.4 g/cm3)
-    density = 0.4
+    # Default density (0.4 g/cm3), see polymerize.get_melt_density for an estimate of the melt density
+    density = density.value if density is not None else 0.4
     avogadro_number = 6.022e23  # molecules/mol
     cm_to_nm = 1e7  # cm to nm conversion factor
     
@@ -23,28 +32,199 @@ def calc_simulation_box_length(molecular_weight_polymer: Float, polymer_count: I
 
     return Float(box_length)
 
+@calcfunction
+def calc_blend_box_length(molecular_weight_list: List, polymer_count_list: List, density_list: List) -> Float:
+    # the volumes of the components add up, each at its own melt density
+    avogadro_number = 6.022e23  # molecules/mol
+    cm_to_nm = 1e7  # cm to nm conversion factor
+
+    volume = sum(molecular_weight * polymer_count / avogadro_number / density  # cm³
+                 for molecular_weight, polymer_count, density in zip(molecular_weight_list.get_list(), polymer_count_list.get_list(), density_list.get_list()))
+    box_length = volume**(1/3) * cm_to_nm  # nm
+
+    return Float(box_length)
+
 @calcfunction
 def get_polymer_name(monomerfname: Str) -> Str:
     return Str(monomerfname.value.replace('Monomer.pdb', ''))
 
+# Topology files
+'''
+A .top or .itp is held as a list of blocks in file order. A block is one [ section ] with the lines under
+it, or a run of lines outside any section ('section': None): the head of the file and every top-level
+#include with the comments in front of it. Preprocessor lines inside a section, like the #ifdef POSRES
+around the position restraint include, stay in that section, so format_top gives back the file line by
+line. A molecule type is the run of blocks from its [ moleculetype ] up to the next molecule type, a
+top-level #include or [ system ]. Edits work on the blocks in memory and touch only the lines they change.
+'''
+topology_end_section_list = ['moleculetype', 'system', 'molecules']
+
+def is_data_line(line: str) -> bool:
+    line = line.strip()
+    return len(line) > 0 and line[0] not in ';#'
+
+def parse_top(content: str) -> list:
+    block_list = [{'section': None, 'lines': []}]
+    ifdef_depth = 0
+    for line in content.split('\n'):
+        word_list = line.split(';')[0].split()
+        if line.strip().startswith('[') and line.strip().endswith(']'):
+            block_list.append({'section': line.strip()[1:-1].strip(), 'header': line, 'lines': []})
+            continue
+        if len(word_list) > 0 and word_list[0] in ['#ifdef', '#ifndef', '#if']:
+            ifdef_depth += 1
+        elif len(word_list) > 0 and word_list[0] == '#endif':
+            ifdef_depth -= 1
+        elif len(word_list) > 0 and word_list[0] == '#include' and ifdef_depth == 0 and block_list[-1]['section'] is not None:
+            # the comments right above an include belong to it
+            lines = block_list[-1]['lines']
+            start = len(lines)
+            while start > 0 and not is_data_line(lines[start - 1]) and not lines[start - 1].strip().startswith('#'):
+                start -= 1
+            while start < len(lines) and lines[start].strip() == '':
+                start += 1
+            block_list.append({'section': None, 'lines': lines[start:]})
+            del lines[start:]
+        block_list[-1]['lines'].append(line)
+    return block_list
+
+def format_top(block_list: list) -> str:
+    lines = []
+    for block in block_list:
+        if block['section'] is not None:
+            lines.append(block['header'])
+        lines.extend(block['lines'])
+    return '\n'.join(lines)
+
+def get_data_line_index(block: dict) -> list:
+    return [iline for iline, line in enumerate(block['lines']) if is_data_line(line)]
+
+def get_moleculetype_list(block_list: list) -> list:
+    # (name, first block, block after the last one) of every molecule type
+    moleculetype_list = []
+    for iblock, block in enumerate(block_list):
+        if block['section'] != 'moleculetype':
+            continue
+        name = block['lines'][get_data_line_index(block)[0]].split()[0]
+        end = iblock + 1
+        while end < len(block_list) and block_list[end]['section'] not in [None] + topology_end_section_list:
+            end += 1
+        moleculetype_list.append((name, iblock, end))
+    return moleculetype_list
+
+def rename_moleculetype(block_list: list, name: str, new_name: str):
+    # only the [ moleculetype ] and [ molecules ] entries name a molecule type
+    for block in block_list:
+        if block['section'] not in ['moleculetype', 'molecules']:
+            continue
+        for iline in get_data_line_index(block):
+            word_list = block['lines'][iline].split()
+            if word_list[0] == name:
+                block['lines'][iline] = block['lines'][iline].replace(name, new_name, 1)
+
+def get_molecules_block(block_list: list) -> dict:
+    molecules_block_list = [block for block in block_list if block['section'] == 'molecules']
+    if len(molecules_block_list) == 0:
+        raise Exception('ERROR: the topology has no [ molecules ] section')
+    return molecules_block_list[-1]
+
+def get_molecule_count_list(block_list: list) -> list:
+    block = get_molecules_block(block_list)
+    return [(block['lines'][iline].split()[0], int(block['lines'][iline].split()[1])) for iline in get_data_line_index(block)]
+
+def set_molecule_count_list(block_list: list, molecule_count_list: list):
+    # rewrite [ molecules ] in the given order; comments in the section are kept
+    block = get_molecules_block(block_list)
+    data_line_index = get_data_line_index(block)
+    if len(data_line_index) > 0:
+        first = data_line_index[0]
+    else:
+        first = len(block['lines'])
+        while first > 0 and block['lines'][first - 1].strip() == '':
+            first -= 1
+    lines = [line for iline, line in enumerate(block['lines']) if iline not in data_line_index]
+    block['lines'] = lines[:first] + ['%-15s %5d' % (name, count) for name, count in molecule_count_list] + lines[first:]
+
+def set_molecule_count(block_list: list, name: str, count: int):
+    molecule_count_list = get_molecule_count_list(block_list)
+    if name not in [molecule_name for molecule_name, _ in molecule_count_list]:
+        raise Exception(f'ERROR: molecule {name} is not in [ molecules ]')
+    set_molecule_count_list(block_list, [(molecule_name, count if molecule_name == name else molecule_count)
+                                         for molecule_name, molecule_count in molecule_count_list])
+
 @calcfunction
 def convert_top_to_itp(top: SinglefileData, filename: Str) -> SinglefileData:
-    lines = top.get_content().split('\n')
-    itp_lines = []
-    write = False
-    for line in lines:
-        if line.startswith('[ moleculetype ]'):
-            write = True
-
-        if write:
-            if line.startswith('; Include water topology'):
-                write = False
-                break
-            else:
-                if line.startswith('Other'):
-                    line = line.replace('Other', f'{filename.value[:-4]}')
-                itp_lines.append(line)
-    return SinglefileData.from_string('\n'.join(itp_lines), filename=filename.value)
+    block_list = parse_top(top.get_content())
+    name, start, end = get_moleculetype_list(block_list)[0]
+    block_list = block_list[start:end]
+    rename_moleculetype(block_list, name, filename.value[:-4])
+    return SinglefileData.from_string(format_top(block_list), filename=filename.value)
+
+@calcfunction
+def update_top_molecule_count(top: SinglefileData, molecule_count: Int, molecule_name: Str = None) -> SinglefileData:
+    # molecule count of one [ molecules ] entry, the first one when no name is given
+    block_list = parse_top(top.get_content())
+    molecule_name = molecule_name.value if molecule_name is not None else get_molecule_count_list(block_list)[0][0]
+    set_molecule_count(block_list, molecule_name, molecule_count.value)
+    return SinglefileData.from_string(format_top(block_list), filename=top.filename)
+
+# Hydrogen mass repartitioning
+'''
+Every hydrogen gets hmr_hydrogen_mass and the atom it is bonded to gives up the same amount, so the mass of
+each molecule and its centre of mass stay the same while the fastest bond-angle motions slow down enough for
+a 4 fs timestep with constraints = h-bonds. Only the molecule types written in the file are changed, water
+and ions from the force field includes keep their masses. The [ atoms ] lines need the mass column, which
+get_polymer_topology and pdb2gmx both write.
+'''
+hmr_hydrogen_mass = 3.024  # amu, three times the hydrogen mass
+hmr_timestep = 0.004  # ps
+default_timestep = 0.002  # ps
+hydrogen_mass_limit = 1.5  # amu, lighter atoms are hydrogens
+
+def set_line_field(line: str, ifield: int, value: str) -> str:
+    # replace one whitespace separated field, right aligned where the old one ended
+    data, separator, comment = line.partition(';')
+    start, end = [match.span() for match in re.finditer(r'\S+', data)][ifield]
+    value = value.rjust(end - start)
+    return data[:end - len(value)] + value + data[end:] + separator + comment
+
+def repartition_moleculetype_mass(block_list: list, hydrogen_mass: float = hmr_hydrogen_mass):
+    # in place, on the blocks of one molecule type
+    atom_line = {}  # atom nr -> (block, line index)
+    mass = {}
+    bond_list = []
+    for block in block_list:
+        for iline in get_data_line_index(block):
+            field_list = block['lines'][iline].split(';')[0].split()
+            if block['section'] == 'atoms':
+                if len(field_list) < 8:
+                    raise Exception(f'ERROR: no mass in the [ atoms ] line "{block["lines"][iline]}"')
+                atom_line[int(field_list[0])] = (block, iline)
+                mass[int(field_list[0])] = float(field_list[7])
+            elif block['section'] == 'bonds':
+                bond_list.append((int(field_list[0]), int(field_list[1])))
+
+    new_mass = dict(mass)
+    for ai, aj in bond_list:
+        for hydrogen, heavy in [(ai, aj), (aj, ai)]:
+            if mass[hydrogen] < hydrogen_mass_limit <= mass[heavy]:
+                new_mass[heavy] -= hydrogen_mass - mass[hydrogen]
+                new_mass[hydrogen] = hydrogen_mass
+    for nr, atom_mass in new_mass.items():
+        if atom_mass < hydrogen_mass_limit and mass[nr] >= hydrogen_mass_limit:
+            raise Exception(f'ERROR: atom {nr} is left with {atom_mass:g} amu after hydrogen mass repartitioning')
+        if atom_mass != mass[nr]:
+            block, iline = atom_line[nr]
+            block['lines'][iline] = set_line_field(block['lines'][iline], 7, '%g' % round(atom_mass, 6))
+
+@calcfunction
+def repartition_hydrogen_mass(top: SinglefileData, hydrogen_mass: Float = None) -> SinglefileData:
+    # .top or .itp with heavier hydrogens, the name of the file is kept so the includes still match
+    hydrogen_mass = hydrogen_mass.value if hydrogen_mass is not None else hmr_hydrogen_mass
+    block_list = parse_top(top.get_content())
+    for _, start, end in get_moleculetype_list(block_list):
+        repartition_moleculetype_mass(block_list[start:end], hydrogen_mass)
+    return SinglefileData.from_string(format_top(block_list), filename=top.filename)
 
 # This will only work for binary blend of polymers
 @calcfunction
@@ -97,119 +277,354 @@ def check_insert_molecules(log: SinglefileData, polymer_count: Int) -> Int:
     else:
         return polymer_count_inserted
 
+# Box sizing for gmx insert-molecules
+'''
+Instead of growing the box by a fixed 5 nm after every failed insert-molecules run, several box lengths
+between the melt-density estimate of calc_simulation_box_length and that estimate plus box_probe_width are
+submitted at once. The smallest box that takes all chains and the largest one that does not bracket the
+answer, and every following round submits box_probe_count lengths inside the bracket, so the bracket
+shrinks by a factor of box_probe_count + 1 per round. If no probe fits, the window is moved up.
+Blend components are inserted one after another into the same box, as in the notebooks.
+'''
+box_probe_count = 4
+box_probe_width = 5.0  # nm
+box_length_tolerance = 0.1  # nm
+box_poll_interval = 5.0  # seconds
+box_max_round = 20
+
+def wait_for_nodes(node_list: list, poll_interval: float = box_poll_interval):
+    while not all(node.is_terminated for node in node_list):
+        time.sleep(poll_interval)
+
+def submit_insert_molecules(gmx_code, box_length: Float, polymer: SinglefileData, polymer_count: Int,
+                            melt_pdb: SinglefileData = None, seed: Int = None):
+    nodes = {'box_length': box_length, 'polymer': polymer, 'polymer_count': polymer_count,
+             'seed': seed if seed is not None else Int(1)}
+    arguments = 'insert-molecules -box {box_length} -ci {polymer} -nmol {polymer_count} -try 999 -seed {seed} -o melt.pdb'
+    if melt_pdb is not None:
+        nodes['melt_pdb'] = melt_pdb
+        arguments = arguments.replace('insert-molecules', 'insert-molecules -f {melt_pdb}')
+    _, node = launch_shell_job(
+        gmx_code,
+        arguments=arguments,
+        nodes=nodes,
+        outputs=['melt.pdb'],
+        metadata={'call_link_label': 'insert_molecules', 'options': {'redirect_stderr': True}},
+        submit=True,
+    )
+    return node
+
+def probe_box_length(gmx_code, box_length_list: list, polymer_list: list, polymer_count_list: list, seed: Int = None) -> list:
+    '''
+    Insert all components into every box length concurrently. Returns the final insert-molecules node
+    for every box length that took all chains and None for the others.
+    '''
+    node_list = [None] * len(box_length_list)
+    alive_list = list(range(len(box_length_list)))
+    for polymer, polymer_count in zip(polymer_list, polymer_count_list):
+        for ibox in alive_list:
+            melt_pdb = node_list[ibox].outputs.melt_pdb if node_list[ibox] is not None else None
+            node_list[ibox] = submit_insert_molecules(gmx_code, Float(float(box_length_list[ibox])), polymer, Int(polymer_count), melt_pdb, seed)
+        wait_for_nodes([node_list[ibox] for ibox in alive_list])
+
+        next_alive_list = []
+        for ibox in alive_list:
+            node = node_list[ibox]
+            if not node.is_finished_ok:
+                raise Exception(f'ERROR: insert-molecules failed for box length {box_length_list[ibox]} nm', node.pk)
+            polymer_count_inserted = check_insert_molecules(node.outputs.stdout, Int(polymer_count))
+            if polymer_count_inserted.value == polymer_count:
+                next_alive_list.append(ibox)
+            else:
+                node_list[ibox] = None
+        alive_list = next_alive_list
+    return [node_list[ibox] if ibox in alive_list else None for ibox in range(len(box_length_list))]
+
+def size_insert_molecules_box(gmx_code, polymer_list: list, polymer_count_list: list, molecular_weight: Float,
+                              density: Float = None, seed: Int = None, probe_count: int = box_probe_count, probe_width: float = box_probe_width,
+                              tolerance: float = box_length_tolerance, max_round: int = box_max_round) -> tuple:
+    '''
+    Bisect toward the smallest box that fits polymer_count_list[i] copies of polymer_list[i] for every component.
+    molecular_weight is the total mass of all chains and density the melt density (g/cm3). Returns the box length (nm) and the insert-molecules
+    node of the final component in that box, whose melt_pdb output is the packed melt.
+    '''
+    density = density if density is not None else Float(0.4)
+    lower = calc_simulation_box_length(molecular_weight, Int(1), density).value
+    # the melt-density estimate itself is probed too, it is the smallest box worth having
+    box_length_list = list(np.linspace(lower, lower + probe_width, probe_count))
+    upper, upper_node = None, None
+    for _ in range(max_round):
+        node_list = probe_box_length(gmx_code, box_length_list, polymer_list, polymer_count_list, seed)
+        fit_list = [ibox for ibox, node in enumerate(node_list) if node is not None]
+        if len(fit_list) > 0:
+            upper, upper_node = box_length_list[fit_list[0]], node_list[fit_list[0]]
+            if fit_list[0] > 0:
+                lower = box_length_list[fit_list[0] - 1]
+        else:
+            lower = box_length_list[-1]
+
+        if upper is None:
+            box_length_list = list(lower + probe_width * np.arange(1, probe_count + 1) / probe_count)
+        elif upper - lower <= tolerance:
+            break
+        else:
+            box_length_list = list(np.linspace(lower, upper, probe_count + 2)[1:-1])
+
+    if upper is None:
+        raise Exception(f'ERROR: no box up to {box_length_list[-1]} nm fits all polymers')
+    return Float(upper), upper_node
+
+# Melt packing
+'''
+Copies of the (equilibrated) chains are put into a periodic box one after another with a random
+orientation and position, like gmx insert-molecules, and a copy is kept once none of its atoms comes
+closer than pack_cutoff to an atom already in the box. Chains of all blend components are drawn in one
+shuffled order so that no component is squeezed into the space left over by another one.
+'''
+pack_cutoff = 2.0  # Angstrom
+pack_max_try = 999
+pack_max_box_step = 100
+pack_box_length_tolerance = 0.1  # nm
+pack_density_fraction = 0.5  # of the melt density, start of the box search, rigid chains rarely pack denser than this
+pack_try_batch = 32  # trial poses tested in one overlap query
+pack_probe_atom_count = 32  # atoms of a trial pose checked before all of them
+
+def get_random_rotation_matrix(rng: np.random.Generator, count: int) -> np.array:
+    # uniform random orientations from normalized gaussian quaternions
+    quaternion = rng.normal(size=(4, count))
+    w, x, y, z = quaternion / np.linalg.norm(quaternion, axis=0)
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)], axis=-1),
+        np.stack([2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)], axis=-1),
+        np.stack([2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)], axis=-1)
+    ], axis=-2)
+
+def pack_melt_structure(molecule_list: list, molecule_count_list: list, box: np.array, seed: int = 0,
+                        cutoff: float = pack_cutoff, max_try: int = pack_max_try, stop_on_miss: bool = False) -> tuple:
+    '''
+    Pack molecule_count_list[i] copies of molecule_list[i] into a periodic box (Angstrom).
+    Returns the melt with the copies grouped per molecule in the given order, as [ molecules ] expects,
+    and the number of copies that could be placed for every molecule.
+    With stop_on_miss, packing ends at the first copy that does not fit, e.g. while probing box lengths.
+    '''
+    box = np.broadcast_to(np.asarray(box, dtype=np.float64), (3,))
+    rng = np.random.default_rng(seed)
+    cell_list = get_cell_list(cutoff, box)
+    centered_coord_list = [molecule['coord'] - molecule['coord'].mean(axis=0) for molecule in molecule_list]
+
+    placed_coord_list = [[] for _ in molecule_list]
+    for imolecule in rng.permutation(np.repeat(np.arange(len(molecule_list)), molecule_count_list)):
+        centered_coord = centered_coord_list[imolecule]
+        for try_start in range(0, max_try, pack_try_batch):
+            try_count = min(pack_try_batch, max_try - try_start)
+            rotation_matrix = get_random_rotation_matrix(rng, try_count)
+            coord = np.einsum('ij,tkj->tik', centered_coord, rotation_matrix) + (rng.random((try_count, 3)) * box)[:, None, :]
+            # most poses are rejected by a few atoms spread over the chain
+            probe_stride = max(len(centered_coord) // pack_probe_atom_count, 1)
+            try_index = np.flatnonzero(~find_overlap(cell_list, coord[:, ::probe_stride]).reshape(try_count, -1).any(axis=1))
+            itry = next((itry for itry in try_index if not find_overlap(cell_list, coord[itry]).any()), None)
+            if itry is not None:
+                coord = coord[itry]
+                add_cell_atom(cell_list, coord)
+                placed_coord_list[imolecule].append(coord)
+                break
+        else:
+            if stop_on_miss:
+                break
+
+    part_list = []
+    residue_offset = 0
+    for molecule, placed_coord in zip(molecule_list, placed_coord_list):
+        if len(placed_coord) == 0:
+            continue
+        copy_count = len(placed_coord)
+        atom_count = len(molecule['coord'])
+        residue_count = int(molecule['residue_seq_num'].max() - molecule['residue_seq_num'].min()) + 1
+        part = {key: molecule[key] for key in ['atom_name_table', 'residue_name_table', 'element_table']}
+        for key in ['atom_name', 'residue_name', 'element']:
+            part[key] = np.tile(molecule[key], copy_count)
+        part['residue_seq_num'] = (np.tile(molecule['residue_seq_num'] - molecule['residue_seq_num'].min(), copy_count) +
+                                   np.repeat(residue_offset + np.arange(copy_count) * residue_count, atom_count))
+        part['coord'] = np.concatenate(placed_coord)
+        part_list.append(part)
+        residue_offset += copy_count * residue_count
+
+    melt = concatenate_structure(part_list)
+    melt['box'] = box.copy()
+    return melt, [len(placed_coord) for placed_coord in placed_coord_list]
+
+@calcfunction
+def pack_melt(box_length: Float, polymer_count_list: List, seed: Int = None, box_length_step: Float = None, **polymer) -> dict:
+    '''
+    In-process replacement of the gmx insert-molecules retry loop for one or more blend components.
+    polymer_0, polymer_1, ... are the single chains (.gro/.pdb) in the order of polymer_count_list, box_length is the box length (nm)
+    at the melt density, the smallest box searched. The search starts at pack_density_fraction of the melt density and steps
+    up, or down while all chains fit, with a step doubling from box_length_step, at most pack_max_box_step steps above box_length.
+    The smallest fitting box is then bisected down to pack_box_length_tolerance.
+    '''
+    seed = seed if seed is not None else Int(0)
+    box_length_step = box_length_step if box_length_step is not None else Float(0.5)
+    polymer_key_list = sorted(polymer, key=lambda key: int(key.split('_')[-1]))
+    molecule_list = [read_structure_singlefile(polymer[key]) for key in polymer_key_list]
+    polymer_count_list = polymer_count_list.get_list()
+    min_box_length = box_length.value
+    max_box_length = min_box_length + pack_max_box_step * box_length_step.value
+
+    lower, upper = None, None
+    probe_box_length, step = min_box_length * pack_density_fraction**(-1/3), box_length_step.value
+    while True:
+        last_probe = upper is None and probe_box_length >= max_box_length
+        probe_melt, probe_count_inserted_list = pack_melt_structure(molecule_list, polymer_count_list, np.full(3, probe_box_length * 10.0), 
+                                                                    seed.value, stop_on_miss=not last_probe)
+        print(f'Packing into a {probe_box_length:.2f} nm box: {sum(probe_count_inserted_list)} of {sum(polymer_count_list)} polymers inserted.')
+        if probe_count_inserted_list == polymer_count_list or last_probe:
+            upper, melt, polymer_count_inserted_list = probe_box_length, probe_melt, probe_count_inserted_list
+        else:
+            lower = probe_box_length
+
+        if last_probe:
+            print(f'WARNING: {polymer_count_inserted_list} polymers are inserted in the simulation box instead of {polymer_count_list}.')
+            break
+        elif upper is None:
+            probe_box_length, step = min(probe_box_length + step, max_box_length), 2.0 * step
+        elif lower is None and upper > min_box_length:
+            probe_box_length, step = max(probe_box_length - step, min_box_length), 2.0 * step
+        elif lower is not None and upper - lower > pack_box_length_tolerance:
+            probe_box_length = 0.5 * (lower + upper)
+        else:
+            break
+    box = melt['box']
+
+    return {
+        'melt_pdb': get_structure_singlefile(melt, 'melt.pdb', box=box),
+        'melt_gro': get_structure_singlefile(melt, 'melt.gro', box=box),
+        'polymer_count_list': List(polymer_count_inserted_list),
+        'box_length': Float(box[0] / 10.0),
+    }
+
+# Staged MD runs
+'''
+A stage is one grompp on the local code and one mdrun on gmx_code. When the previous stage left a
+checkpoint, grompp reads it with -t, so positions, velocities, box and thermostat and barostat state carry
+over. The .mdp of such a stage has to set continuation = yes, which also turns gen_vel off in mdp_builder,
+so a stage never throws away the thermalized velocities of the one before.
+A stage with a target_density is repeated with its repeat_mdp until the average density over the last
+density_average_fraction of the run reaches it, at most max_density_repeat times.
+'''
+density_average_fraction = 0.25
+max_density_repeat = 5
+
+def run_md_stage(gmx_local, gmx_code, name: str, mdp: SinglefileData, gro: SinglefileData, top: SinglefileData,
+                 cpt: SinglefileData = None, nodes: dict = None, mdrun_arguments: str = '', metadata: dict = None) -> dict:
+    # outputs of mdrun -deffnm name, e.g. {name}_gro, {name}_cpt and {name}_edr
+    grompp_nodes = {'mdp': mdp, 'gro': gro, 'top': top, **(nodes if nodes is not None else {})}
+    arguments = f'grompp -f {{mdp}} -c {{gro}} -p {{top}} -o {name}.tpr'
+    if cpt is not None:
+        if parse_mdp(mdp.get_content()).get('continuation', 'no').lower() != 'yes':
+            raise Exception(f'ERROR: {mdp.filename} continues from a checkpoint but does not set continuation = yes')
+        grompp_nodes['cpt'] = cpt
+        arguments += ' -t {cpt}'
+    results_grompp, _ = launch_shell_job(
+        gmx_local,
+        arguments=arguments,
+        nodes=grompp_nodes,
+        filenames={'folder': 'oplsaa.ff'} if 'folder' in grompp_nodes else None,
+        outputs=[f'{name}.tpr'],
+        metadata={'options': {'redirect_stderr': True}},
+    )
+    results_mdrun, _ = launch_shell_job(
+        gmx_code,
+        arguments=f'mdrun -v -deffnm {name} -s {{tpr}}{mdrun_arguments}',
+        nodes={'tpr': results_grompp[f'{name}_tpr']},
+        outputs=[f'{name}.*'],
+        metadata=metadata,
+    )
+    return results_mdrun
+
+@calcfunction
+def get_final_density(xvg: SinglefileData) -> Float:
+    # g/cm3 from the Density (kg/m3) of gmx energy, averaged over the end of the run
+    data = np.loadtxt(xvg.get_content().split('\n'), comments=['#', '@'], ndmin=2)
+    last_count = max(1, int(len(data) * density_average_fraction))
+    return Float(data[-last_count:, 1].mean() / 1000.0)
+
+def calc_stage_density(gmx_local, name: str, edr: SinglefileData) -> float:
+    output = f'{name}_density.xvg'
+    results, _ = launch_shell_job(
+        gmx_local,
+        arguments='energy -f {edr} -o {output}',
+        nodes={
+            'edr': edr,
+            'output': Str(output),
+            'stdin': SinglefileData.from_string('Density\n0'),
+        },
+        outputs=[output],
+        metadata={'options': {'redirect_stderr': True, 'filename_stdin': 'stdin'}},
+    )
+    return get_final_density(results[output.replace('.', '_')]).value
+
+def run_md_protocol(gmx_local, gmx_code, stage_list: list, gro: SinglefileData, top: SinglefileData,
+                    cpt: SinglefileData = None, nodes: dict = None, mdrun_arguments: str = '', metadata: dict = None) -> list:
+    # stages of mdp_builder.get_densification_protocol in order, each one from the state the one before left
+    results_list = []
+    for stage in stage_list:
+        name = stage['name']
+        results = run_md_stage(gmx_local, gmx_code, name, stage['mdp'], gro, top, cpt, nodes, mdrun_arguments, metadata)
+        results_list.append(results)
+        gro, cpt = results[f'{name}_gro'], results[f'{name}_cpt']
+        if 'target_density' not in stage:
+            continue
+
+        density = calc_stage_density(gmx_local, name, results[f'{name}_edr'])
+        print(f'{name}: density {density:.3f} g/cm3, target {stage["target_density"]:.3f} g/cm3')
+        for irepeat in range(1, max_density_repeat + 1):
+            if density >= stage['target_density']:
+                break
+            name = f'{stage["name"]}_{irepeat}'
+            results = run_md_stage(gmx_local, gmx_code, name, stage['repeat_mdp'], gro, top, cpt, nodes, mdrun_arguments, metadata)
+            results_list.append(results)
+            gro, cpt = results[f'{name}_gro'], results[f'{name}_cpt']
+            density = calc_stage_density(gmx_local, name, results[f'{name}_edr'])
+            print(f'{name}: density {density:.3f} g/cm3, target {stage["target_density"]:.3f} g/cm3')
+        if density < stage['target_density']:
+            print(f'WARNING: the melt ends the compression below the target density of {stage["target_density"]:.3f} g/cm3.')
+    return results_list
+
 @calcfunction
 def get_em_mdp() -> SinglefileData:
-    return SinglefileData.from_string(
-        """
-        integrator      = steep
-        emtol           = 1000.0
-        emstep          = 0.01
-        nsteps          = 50000
-        nstlist         = 1
-        cutoff-scheme   = Verlet
-        ns_type         = grid
-        coulombtype     = PME
-        rcoulomb        = 1.0
-        rvdw            = 1.0
-        pbc             = xyz
-        ld_seed         = 1
-        gen_seed        = 1
-        """,
-        filename='em.mdp',
-        )
+    return SinglefileData.from_string(format_mdp(get_mdp_parameters('em')), filename='em.mdp')
 
 @calcfunction
-def get_nvt_mdp(id: Int = None, temperature: Float = None) -> SinglefileData:
+def get_nvt_mdp(id: Int = None, temperature: Float = None, hydrogen_mass_repartitioning: Bool = None, preset: Str = None,
+                continuation: Bool = None) -> SinglefileData:
     
     id = id if id is not None else Int(0)
     temperature = temperature if temperature is not None else Float(298.15)
+    # topologies from repartition_hydrogen_mass run at 4 fs
+    hydrogen_mass_repartitioning = hydrogen_mass_repartitioning if hydrogen_mass_repartitioning is not None else Bool(False)
+    dt = hmr_timestep if hydrogen_mass_repartitioning.value else default_timestep
+    preset = preset.value if preset is not None else None
+    # with continuation the velocities come from the checkpoint passed to grompp -t, otherwise they are generated at temperature
+    continuation = continuation if continuation is not None else Bool(False)
     
-    mdp_str = f"""
-        title                   = NPT Equilibration
-        ;define                 = -DPOSRES
-        integrator              = md
-        dt                      = 0.002
-        nsteps                  = 50000
-        nstenergy               = 2000
-        nstxout-compressed      = 10000
-        nstvout                 = 0
-        nstlog                  = 1000
-        gen_vel                 = yes
-        gen_temp                = 298.15
-        pbc                     = xyz
-        cutoff-scheme           = Verlet
-        rlist                   = 1.0
-        ns_type                 = grid
-        nstlist                 = 10
-        coulombtype             = PME
-        fourierspacing          = 0.12
-        pme_order               = 4
-        rcoulomb                = 1.0
-        vdwtype                 = Cut-Off
-        rvdw                    = 1.0
-        DispCorr                = EnerPres
-        constraints             = h-bonds
-        constraint_algorithm    = lincs
-        lincs_iter              = 1
-        lincs_order             = 4
-        tcoupl                  = v-rescale
-        tc-grps                 = System
-        ref_t                   = {temperature.value}
-        tau_t                   = 0.1
-        pcoupl                  = no
-        ;refcoord-scaling        = com
-        compressibility         = 4.5e-5
-        """
-    
-    return SinglefileData.from_string(mdp_str, filename=f'eqnvt-{id.value}.mdp')
+    mdp_parameters = get_mdp_parameters('nvt', preset, dt=dt, ref_t=temperature.value, continuation=continuation.value)
+    return SinglefileData.from_string(format_mdp(mdp_parameters), filename=f'eqnvt-{id.value}.mdp')
 
 @calcfunction
-def get_npt_mdp(id: Int = None, temperature: Float = None, pressure: Float = None, dt: Float = None, nsteps: Int = None) -> SinglefileData:
+def get_npt_mdp(id: Int = None, temperature: Float = None, pressure: Float = None, dt: Float = None, nsteps: Int = None,
+                hydrogen_mass_repartitioning: Bool = None, preset: Str = None, continuation: Bool = None) -> SinglefileData:
     
     id = id if id is not None else Int(0)
     temperature = temperature if temperature is not None else Float(298.15)
     pressure = pressure if pressure is not None else Float(1.0)
-    dt = dt if dt is not None else Float(0.002)
+    # topologies from repartition_hydrogen_mass run at 4 fs unless dt is given
+    hydrogen_mass_repartitioning = hydrogen_mass_repartitioning if hydrogen_mass_repartitioning is not None else Bool(False)
+    dt = dt if dt is not None else Float(hmr_timestep if hydrogen_mass_repartitioning.value else default_timestep)
     nsteps = nsteps if nsteps is not None else Int(500000)
+    preset = preset.value if preset is not None else None
+    # with continuation the velocities come from the checkpoint passed to grompp -t, otherwise they are generated at temperature
+    continuation = continuation if continuation is not None else Bool(False)
     
-    mdp_str = f"""
-        title                   = NPT Equilibration
-        ;define                 = -DPOSRES
-        integrator              = md
-        dt                      = {dt.value}
-        nsteps                  = {nsteps.value}
-        nstenergy               = 2000
-        nstxout-compressed      = 10000
-        nstvout                 = 0
-        nstlog                  = 1000
-        gen_vel                 = yes
-        gen_temp                = 298.15
-        pbc                     = xyz
-        cutoff-scheme           = Verlet
-        rlist                   = 1.0
-        ns_type                 = grid
-        nstlist                 = 10
-        coulombtype             = PME
-        fourierspacing          = 0.12
-        pme_order               = 4
-        rcoulomb                = 1.0
-        vdwtype                 = Cut-Off
-        rvdw                    = 1.0
-        DispCorr                = EnerPres
-        constraints             = h-bonds
-        constraint_algorithm    = lincs
-        lincs_iter              = 1
-        lincs_order             = 4
-        tcoupl                  = v-rescale
-        tc-grps                 = System
-        ref_t                   = {temperature.value}
-        tau_t                   = 0.1
-        pcoupl                  = c-rescale
-        pcoupltype              = isotropic
-        ref_p                   = {pressure.value}
-        tau_p                   = 2.0
-        ;refcoord-scaling        = com
-        compressibility         = 4.5e-5
-        """
-    
-    return SinglefileData.from_string(mdp_str, filename=f'eqnpt-{id.value}.mdp')
\ No newline at end of file
+    mdp_parameters = get_mdp_parameters('npt', preset, dt=dt.value, nsteps=nsteps.value, ref_t=temperature.value, ref_p=pressure.value,
+                                        continuation=continuation.value)
+    return SinglefileData.from_string(format_mdp(mdp_parameters), filename=f'eqnpt-{id.value}.mdp')
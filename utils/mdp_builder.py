@@ -0,0 +1,304 @@
+import hashlib
+
+from aiida.orm import SinglefileData, QueryBuilder
+
+# MDP files from typed parameters
+'''
+An .mdp is built from the parameters of a stage (em, nvt, npt), the overrides of zero or more named
+presets and the keyword arguments of the call, in that order. Every parameter is checked against
+mdp_parameter_type and written in its canonical spelling and in the order of that table, so equal
+parameters always give the same text. The node of an .mdp is looked up by a hash of its content and
+filename before a new one is stored, so a rerun of the pipeline reuses the .mdp nodes of the first run.
+Keyword arguments use underscores where the .mdp uses dashes, e.g. nstxout_compressed. Velocities are
+generated at ref-t unless gen-temp is given, and a run with continuation = yes does not generate any.
+'''
+# value type, or the list of allowed values
+mdp_parameter_type = {
+    'title': str,
+    'define': str,
+    'integrator': ['md', 'sd', 'steep', 'cg', 'l-bfgs'],
+    'dt': float,
+    'nsteps': int,
+    'emtol': float,
+    'emstep': float,
+    'nstxout': int,
+    'nstvout': int,
+    'nstfout': int,
+    'nstlog': int,
+    'nstcalcenergy': int,
+    'nstenergy': int,
+    'nstxout-compressed': int,
+    'continuation': bool,
+    'gen-vel': bool,
+    'gen-temp': float,
+    'gen-seed': int,
+    'ld-seed': int,
+    'pbc': ['xyz', 'no', 'xy'],
+    'cutoff-scheme': ['Verlet'],
+    'nstlist': int,
+    'rlist': float,
+    'verlet-buffer-tolerance': float,
+    'coulombtype': ['PME', 'Cut-off', 'Reaction-Field'],
+    'rcoulomb': float,
+    'fourierspacing': float,
+    'pme-order': int,
+    'vdwtype': ['Cut-off', 'PME'],
+    'rvdw': float,
+    'DispCorr': ['no', 'EnerPres', 'Ener'],
+    'constraints': ['none', 'h-bonds', 'all-bonds', 'h-angles', 'all-angles'],
+    'constraint-algorithm': ['lincs', 'shake'],
+    'lincs-iter': int,
+    'lincs-order': int,
+    'tcoupl': ['no', 'berendsen', 'nose-hoover', 'v-rescale'],
+    'nsttcouple': int,
+    'tc-grps': str,
+    'tau-t': float,
+    'ref-t': float,
+    'pcoupl': ['no', 'berendsen', 'c-rescale', 'parrinello-rahman'],
+    'pcoupltype': ['isotropic', 'semiisotropic', 'anisotropic'],
+    'nstpcouple': int,
+    'tau-p': float,
+    'ref-p': float,
+    'compressibility': float,
+    'refcoord-scaling': ['no', 'all', 'com'],
+}
+mdp_positive_parameter_list = ['dt', 'emstep', 'rlist', 'rcoulomb', 'rvdw', 'fourierspacing', 'tau-t', 'tau-p', 'ref-t']
+
+md_parameter_dict = {
+    'integrator': 'md',
+    'dt': 0.002,
+    'nsteps': 50000,
+    'nstenergy': 2000,
+    'nstxout-compressed': 10000,
+    'nstvout': 0,
+    'nstlog': 1000,
+    'gen-vel': True,
+    'pbc': 'xyz',
+    'cutoff-scheme': 'Verlet',
+    'rlist': 1.0,
+    'nstlist': 10,
+    'coulombtype': 'PME',
+    'fourierspacing': 0.12,
+    'pme-order': 4,
+    'rcoulomb': 1.0,
+    'vdwtype': 'Cut-off',
+    'rvdw': 1.0,
+    'DispCorr': 'EnerPres',
+    'constraints': 'h-bonds',
+    'constraint-algorithm': 'lincs',
+    'lincs-iter': 1,
+    'lincs-order': 4,
+    'tcoupl': 'v-rescale',
+    'tc-grps': 'System',
+    'ref-t': 298.15,
+    'tau-t': 0.1,
+}
+mdp_stage_dict = {
+    'em': {
+        'integrator': 'steep',
+        'emtol': 1000.0,
+        'emstep': 0.01,
+        'nsteps': 50000,
+        'nstlist': 1,
+        'cutoff-scheme': 'Verlet',
+        'coulombtype': 'PME',
+        'rcoulomb': 1.0,
+        'rvdw': 1.0,
+        'pbc': 'xyz',
+        'ld-seed': 1,
+        'gen-seed': 1,
+    },
+    'nvt': {
+        'title': 'NVT Equilibration',
+        **md_parameter_dict,
+        'pcoupl': 'no',
+    },
+    'npt': {
+        'title': 'NPT Equilibration',
+        **md_parameter_dict,
+        'nsteps': 500000,
+        'pcoupl': 'c-rescale',
+        'pcoupltype': 'isotropic',
+        'ref-p': 1.0,
+        'tau-p': 2.0,
+        'compressibility': 4.5e-5,
+    },
+}
+mdp_preset_dict = {
+    # update, PME and non-bondeds on the GPU: the pair list is pruned on the GPU between searches, energies are
+    # reduced on the host only as often as they are written, and mdrun tunes the coarser PME grid at startup
+    'gpu-resident throughput': {'nstlist': 100, 'nstcalcenergy': 1000, 'fourierspacing': 0.16, 'nstlog': 10000},
+    'cpu': {'nstlist': 10, 'nstcalcenergy': 100, 'fourierspacing': 0.12, 'nstlog': 1000},
+    # equilibration only needs the last frame and a coarse energy trace
+    'short equilibration': {'nsteps': 50000, 'nstxout-compressed': 0, 'nstenergy': 1000, 'nstlog': 5000},
+}
+# gromacs treats dashes and underscores alike
+mdp_key_dict = {key.lower(): key for key in mdp_parameter_type}
+mdp_node_dict = {}  # hash -> node, for the lifetime of the process
+
+def get_mdp_key(key: str) -> str:
+    mdp_key = mdp_key_dict.get(key.replace('_', '-').lower())
+    if mdp_key is None:
+        raise Exception(f'ERROR: unknown mdp parameter {key}')
+    return mdp_key
+
+def convert_mdp_value(key: str, value):
+    value_type = mdp_parameter_type[key]
+    if isinstance(value_type, list):
+        choice_dict = {choice.lower(): choice for choice in value_type}
+        if str(value).lower() not in choice_dict:
+            raise Exception(f'ERROR: {key} = {value} is not one of {value_type}')
+        return choice_dict[str(value).lower()]
+    if value_type is bool:
+        if isinstance(value, str):
+            if value.lower() not in ['yes', 'no']:
+                raise Exception(f'ERROR: {key} = {value} is not yes or no')
+            return value.lower() == 'yes'
+        return bool(value)
+    try:
+        converted = value_type(value)
+    except (TypeError, ValueError):
+        raise Exception(f'ERROR: {key} = {value} is not a {value_type.__name__}')
+    if value_type is int and not isinstance(value, str) and converted != value:
+        raise Exception(f'ERROR: {key} = {value} is not an integer')
+    return converted
+
+def validate_mdp_parameters(parameters: dict):
+    for key in mdp_positive_parameter_list:
+        if key in parameters and parameters[key] <= 0:
+            raise Exception(f'ERROR: {key} = {parameters[key]} has to be positive')
+    for key, value in parameters.items():
+        if key.startswith('nst') and value < (-1 if key == 'nsteps' else 0):
+            raise Exception(f'ERROR: {key} = {value} is negative')
+
+    if 'rlist' in parameters and parameters['rlist'] < max(parameters.get('rcoulomb', 0.0), parameters.get('rvdw', 0.0)):
+        raise Exception('ERROR: rlist is shorter than rcoulomb or rvdw')
+    nstcalcenergy = parameters.get('nstcalcenergy', 0)
+    for key in ['nstenergy', 'nstlog']:
+        if nstcalcenergy > 0 and parameters.get(key, 0) % nstcalcenergy != 0:
+            raise Exception(f'ERROR: {key} = {parameters[key]} is not a multiple of nstcalcenergy = {nstcalcenergy}')
+
+    required_key_dict = {'tcoupl': ['tc-grps', 'tau-t', 'ref-t'], 'pcoupl': ['tau-p', 'ref-p', 'compressibility']}
+    for coupling_key, key_list in required_key_dict.items():
+        missing_key_list = [key for key in key_list if key not in parameters]
+        if parameters.get(coupling_key, 'no') != 'no' and len(missing_key_list) > 0:
+            raise Exception(f'ERROR: {coupling_key} = {parameters[coupling_key]} needs {missing_key_list}')
+    if parameters.get('gen-vel', False) and parameters.get('continuation', False):
+        raise Exception('ERROR: gen-vel and continuation cannot both be yes')
+    if parameters.get('gen-vel', False) and 'ref-t' in parameters and parameters['gen-temp'] != parameters['ref-t']:
+        raise Exception(f'ERROR: gen-temp = {parameters["gen-temp"]} differs from ref-t = {parameters["ref-t"]}')
+
+def get_mdp_parameters(stage: str, preset=None, **parameters) -> dict:
+    # stage parameters, then the presets in the given order, then the keyword arguments
+    if stage not in mdp_stage_dict:
+        raise Exception(f'ERROR: unknown mdp stage {stage}, expected one of {list(mdp_stage_dict)}')
+    preset_list = [] if preset is None else [preset] if isinstance(preset, str) else list(preset)
+    for preset_name in preset_list:
+        if preset_name not in mdp_preset_dict:
+            raise Exception(f'ERROR: unknown mdp preset {preset_name}, expected one of {list(mdp_preset_dict)}')
+
+    mdp_parameters = {}
+    for parameter_dict in [mdp_stage_dict[stage]] + [mdp_preset_dict[name] for name in preset_list] + [parameters]:
+        for key, value in parameter_dict.items():
+            key = get_mdp_key(key)
+            mdp_parameters[key] = convert_mdp_value(key, value)
+    # velocities are generated at the temperature of the thermostat, and not at all when the run continues
+    if mdp_parameters.get('continuation', False) and 'gen-vel' not in [get_mdp_key(key) for key in parameters]:
+        mdp_parameters['gen-vel'] = False
+    if mdp_parameters.get('gen-vel', False) and 'gen-temp' not in mdp_parameters and 'ref-t' in mdp_parameters:
+        mdp_parameters['gen-temp'] = mdp_parameters['ref-t']
+    validate_mdp_parameters(mdp_parameters)
+    return {key: mdp_parameters[key] for key in mdp_parameter_type if key in mdp_parameters}
+
+def format_mdp_value(value) -> str:
+    if isinstance(value, bool):
+        return 'yes' if value else 'no'
+    return repr(value) if isinstance(value, float) else str(value)
+
+def format_mdp(parameters: dict) -> str:
+    return '\n'.join('%-24s= %s' % (key, format_mdp_value(value)) for key, value in parameters.items()) + '\n'
+
+def parse_mdp(content: str) -> dict:
+    # raw values of an .mdp by canonical key, unknown keys are kept as written
+    parameters = {}
+    for line in content.split('\n'):
+        key, separator, value = line.split(';')[0].partition('=')
+        if separator == '':
+            continue
+        key = key.strip()
+        parameters[mdp_key_dict.get(key.replace('_', '-').lower(), key)] = value.strip()
+    return parameters
+
+def get_mdp_node(content: str, filename: str) -> SinglefileData:
+    # stored node with the same content and filename, a new one otherwise
+    key = hashlib.sha256(f'{filename}\n{content}'.encode()).hexdigest()
+    if key not in mdp_node_dict:
+        result = QueryBuilder().append(SinglefileData, filters={'extras.mdp_hash': key}).first()
+        if result is not None:
+            mdp_node_dict[key] = result[0]
+        else:
+            node = SinglefileData.from_string(content, filename=filename).store()
+            node.base.extras.set('mdp_hash', key)
+            mdp_node_dict[key] = node
+    return mdp_node_dict[key]
+
+def get_mdp(stage: str, preset=None, filename: str = None, **parameters) -> SinglefileData:
+    '''
+    .mdp of a stage ('em', 'nvt' or 'npt') with the presets of mdp_preset_dict applied in order and
+    parameters as keyword arguments, e.g. get_mdp('npt', 'gpu-resident throughput', ref_t=400.0).
+    '''
+    filename = filename if filename is not None else f'{stage}.mdp'
+    return get_mdp_node(format_mdp(get_mdp_parameters(stage, preset, **parameters)), filename)
+
+# Densification protocol
+'''
+Melts are packed at a low density and used to be compressed by the production NPT run itself. Instead, a
+short run at high temperature and pressure compresses the melt while the chains are mobile, a few
+annealing cycles alternate between the high and the target temperature while the pressure steps down
+geometrically to the target pressure, and only then the production NPT run starts. Every stage after the
+first continues from the checkpoint of the one before, with its velocities (see gromacs_setup.run_md_protocol).
+With a target density, e.g. the group-contribution estimate of polymerize.get_melt_density, the compression
+is repeated from its own checkpoint until the melt reaches that density.
+'''
+densification_high_temperature = 600.0  # K
+densification_high_pressure = 5000.0  # bar
+densification_anneal_cycle_count = 3
+densification_compression_nsteps = 20000
+densification_anneal_nsteps = 10000
+densification_tau_p = 1.0  # ps
+
+def get_densification_protocol(temperature: float, pressure: float, preset=None, dt: float = None, production_nsteps: int = None,
+                               high_temperature: float = densification_high_temperature,
+                               high_pressure: float = densification_high_pressure,
+                               anneal_cycle_count: int = densification_anneal_cycle_count,
+                               compression_nsteps: int = densification_compression_nsteps,
+                               anneal_nsteps: int = densification_anneal_nsteps,
+                               target_density: float = None) -> list:
+    '''
+    [{'name': ..., 'mdp': ...}] of the compression, the annealing stages and the production NPT run,
+    to be run in order. The stage names are valid link labels, e.g. anneal_1_hot.
+    With target_density (g/cm3) the compression stage also holds it and the repeat_mdp that continues the compression.
+    '''
+    preset_list = [] if preset is None else [preset] if isinstance(preset, str) else list(preset)
+    common_parameters = {} if dt is None else {'dt': dt}
+    compression_parameters = {'ref_t': high_temperature, 'ref_p': high_pressure,
+                              'tau_p': densification_tau_p, 'nsteps': compression_nsteps}
+    stage_list = [('compress', preset_list + ['short equilibration'], compression_parameters)]
+    for icycle in range(1, anneal_cycle_count + 1):
+        cycle_pressure = round(high_pressure * (pressure / high_pressure)**(icycle / anneal_cycle_count), 1)
+        for name, cycle_temperature in [('hot', high_temperature), ('cool', temperature)]:
+            stage_list.append((f'anneal_{icycle}_{name}', preset_list + ['short equilibration'],
+                               {'ref_t': cycle_temperature, 'ref_p': cycle_pressure, 'tau_p': densification_tau_p,
+                                'nsteps': anneal_nsteps, 'continuation': True}))
+    production_parameters = {'ref_t': temperature, 'ref_p': pressure, 'continuation': True}
+    if production_nsteps is not None:
+        production_parameters['nsteps'] = production_nsteps
+    stage_list.append(('production', preset_list, production_parameters))
+
+    protocol = [{'name': name, 'mdp': get_mdp('npt', stage_preset_list, filename=f'{name}.mdp', **common_parameters, **parameters)}
+                for name, stage_preset_list, parameters in stage_list]
+    if target_density is not None:
+        protocol[0]['target_density'] = target_density
+        protocol[0]['repeat_mdp'] = get_mdp('npt', stage_list[0][1], filename='compress_repeat.mdp', 
+                                            **common_parameters, **compression_parameters, continuation=True)
+    return protocol
@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import hashlib
+
+from aiida.orm import SinglefileData, load_node
+from aiida.common.exceptions import NotExistent
+
+from utils.structure_io import read_structure, write_binary, get_structure_singlefile
+
+# Persistent cache of built polymer chains
+'''
+Every entry is keyed by a hash of the monomer file content, the connection points, the number of
+monomers and the build mode. The chain is stored as a memory-mappable binary structure next to an
+index with its molecular weight, the uuids of the polymer (and binary) nodes it was first stored as and the time of
+last access, which is used for LRU eviction once the cache grows above its size limit.
+The binary keeps float32 coordinates, so a miss always builds the chain from scratch instead of extending
+a cached shorter one, and the stored coordinates never depend on what was cached before.
+'''
+default_cache_dir = os.environ.get('AQE_POLYMER_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'aqe_gromacs_polymers'))
+default_max_size = 2 * 1024**3  # bytes
+
+def get_cache_key(monomer_content: bytes, polymer_connection_point_list: list, monomer_count: int, build_mode: str = 'stepwise') -> str:
+    if isinstance(monomer_content, str):
+        monomer_content = monomer_content.encode()
+    key = hashlib.sha256(monomer_content)
+    key.update(json.dumps([list(polymer_connection_point_list), int(monomer_count), build_mode]).encode())
+    return key.hexdigest()
+
+def get_cache_fname(key: str, cache_dir: str = default_cache_dir) -> str:
+    return os.path.join(cache_dir, f'{key}.bin')
+
+def read_cache_index(cache_dir: str = default_cache_dir) -> dict:
+    try:
+        with open(os.path.join(cache_dir, 'index.json')) as handle:
+            return json.load(handle)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def write_cache_index(index: dict, cache_dir: str = default_cache_dir):
+    # write to a temporary file first so readers never see a partial index
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_fname = os.path.join(cache_dir, f'index.json.{os.getpid()}')
+    with open(tmp_fname, 'w') as handle:
+        json.dump(index, handle)
+    os.replace(tmp_fname, os.path.join(cache_dir, 'index.json'))
+
+def get_cached_polymer(key: str, cache_dir: str = default_cache_dir) -> dict:
+    index = read_cache_index(cache_dir)
+    entry = index.get(key)
+    if entry is None or not os.path.exists(get_cache_fname(key, cache_dir)):
+        return None
+
+    entry['last_access'] = time.time()
+    write_cache_index(index, cache_dir)
+    return entry
+
+def read_cached_structure(key: str, cache_dir: str = default_cache_dir) -> dict:
+    return read_structure(get_cache_fname(key, cache_dir), mmap=True)
+
+def get_cached_polymer_node(key: str, entry: dict, cache_dir: str = default_cache_dir) -> SinglefileData:
+    # reuse the stored polymer node so that no duplicate repository file is created
+    if entry.get('polymer_uuid') is not None:
+        try:
+            return load_node(entry['polymer_uuid'])
+        except NotExistent:
+            pass
+    return get_structure_singlefile(read_cached_structure(key, cache_dir), 'polymer.pdb')
+
+def get_cached_polymer_binary(key: str, entry: dict, cache_dir: str = default_cache_dir) -> SinglefileData:
+    # same as get_cached_polymer_node, a new node is only made when no binary node was stored yet
+    if entry.get('polymer_binary_uuid') is not None:
+        try:
+            return load_node(entry['polymer_binary_uuid'])
+        except NotExistent:
+            pass
+    return SinglefileData(get_cache_fname(key, cache_dir), filename='polymer.bin')
+
+def set_cached_polymer_binary_uuid(key: str, polymer_binary_uuid: str, cache_dir: str = default_cache_dir):
+    index = read_cache_index(cache_dir)
+    if key in index:
+        index[key]['polymer_binary_uuid'] = polymer_binary_uuid
+        write_cache_index(index, cache_dir)
+
+def evict_cache(max_size: int = default_max_size, cache_dir: str = default_cache_dir, index: dict = None):
+    index = index if index is not None else read_cache_index(cache_dir)
+    total_size = sum(entry['size'] for entry in index.values())
+    for key in sorted(index, key=lambda key: index[key]['last_access']):
+        if total_size <= max_size:
+            break
+        total_size -= index.pop(key)['size']
+        try:
+            os.remove(get_cache_fname(key, cache_dir))
+        except FileNotFoundError:
+            pass
+    write_cache_index(index, cache_dir)
+
+def store_cached_polymer(key: str, polymer: dict, polymer_molecular_weight: float, polymer_uuid: str = None,
+                         polymer_binary_uuid: str = None, monomer_count: int = None,
+                         cache_dir: str = default_cache_dir, max_size: int = default_max_size):
+    os.makedirs(cache_dir, exist_ok=True)
+    fname = get_cache_fname(key, cache_dir)
+    tmp_fname = f'{fname}.{os.getpid()}'
+    with open(tmp_fname, 'wb') as handle:
+        write_binary(handle, polymer)
+    os.replace(tmp_fname, fname)
+
+    index = read_cache_index(cache_dir)
+    index[key] = {'size': os.path.getsize(fname),
+                  'last_access': time.time(),
+                  'polymer_molecular_weight': float(polymer_molecular_weight),
+                  'polymer_uuid': polymer_uuid,
+                  'polymer_binary_uuid': polymer_binary_uuid,
+                  'monomer_count': monomer_count}
+    evict_cache(max_size, cache_dir, index)
@@ -1,18 +1,24 @@
+import os
+
 # aiida packages
 from aiida.orm import Int, Str, Dict, List
 from aiida.engine import calcfunction
 
+monomer_data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'monomer_data')
+
+pdb_dict = {
+    '1': 'tPBMonomer.pdb',
+    '2': 'PVAMonomer.pdb',
+    '3': 'PMAMonomer.pdb',
+    '4': 'cIPMonomer.pdb',
+    '5': 'PSTMonomer.pdb'
+}
+
 @calcfunction
 def get_pdb(key: Int) -> Str:
-    pdb_dict = Dict(dict={
-        '1': 'tPBMonomer.pdb',
-        '2': 'PVAMonomer.pdb',
-        '3': 'PMAMonomer.pdb',
-        '4': 'cIPMonomer.pdb',
-        '5': 'PSTMonomer.pdb'
-    }).store()
+    pdb_dict_node = Dict(dict=pdb_dict).store()
 
-    result = Str(pdb_dict.get_dict().get(f'{key.value}', "Error: Polymer is not in the current database."))
+    result = Str(pdb_dict_node.get_dict().get(f'{key.value}', "Error: Polymer is not in the current database."))
     
     return result
 
@@ -22,15 +28,17 @@ def get_pdb(key: Int) -> Str:
     - element 1 and element 2 represent the last two atoms bonded where element 2 will be replace by next monomer element.
     - element 3 and element 4 represent the first two atoms bonded where element 3 will be replace by previous monomer element.
 '''
+connection_point_dict = {
+    '1': ['CW', 'HW3', 'HA3', 'CA'],
+    '2': ['CB', 'HB2', 'HA3', 'CA'],
+    '3': ['CW', 'HW3', 'HA2', 'CA'],
+    '4': ['CW', 'HW3', 'HA3', 'CA'],
+    '5': ['CB', 'HB2', 'HA3', 'CA']
+}
+
 @calcfunction
 def get_connection_point(key: Int) -> List:
-    connection_dict = Dict(dict={
-        '1': ['CW', 'HW3', 'HA3', 'CA'],
-        '2': ['CB', 'HB2', 'HA3', 'CA'],
-        '3': ['CW', 'HW3', 'HA2', 'CA'],
-        '4': ['CW', 'HW3', 'HA3', 'CA'],
-        '5': ['CB', 'HB2', 'HA3', 'CA']
-    }).store()
+    connection_dict = Dict(dict=connection_point_dict).store()
 
     result = List(connection_dict.get_dict().get(f'{key.value}', "Error: Polymer is not in the current database."))
 
@@ -0,0 +1,295 @@
+import os
+import glob
+import functools
+import numpy as np
+
+# aiida packages
+from aiida.orm import Int, Str, List, SinglefileData
+from aiida.engine import calcfunction
+
+from utils.structure_io import select_structure, get_column, format_rows
+from utils.polymerize import get_monomer_template, get_polymer_skeleton
+
+forcefield_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'oplsaa.ff')
+
+# Chain topology from the residue templates of the force field
+'''
+Replaces gmx pdb2gmx for the polymers of the residue topology database (e.g. BD1/BD2/BD3 in aminoacids.rtp).
+Atom types, charges, bonds and impropers come from the rtp entries of the starting, repeating and end unit,
+angles, proper dihedrals and 1-4 pairs are generated from the bonds like pdb2gmx does with the OPLS-AA
+[ bondedtypes ] (all dihedrals, nrexcl 3, H-H 1-4 pairs). This is done once for a short chain; every
+interaction belongs to its first residue, and the interactions of one repeating unit are copied to all
+other repeating units of a long chain by offsetting their atom indices. The atoms are in the order of the
+PolymerizeWorkChain output, so the polymer structure can be used with the topology as it is.
+'''
+bond_funct = 1
+pair_funct = 1
+angle_funct = 1
+dihedral_funct = 3
+improper_funct = 1
+nrexcl = 3
+position_restraint_force = 1000  # kJ/mol/nm2
+
+rtp_section_list = ['atoms', 'bonds', 'angles', 'dihedrals', 'impropers', 'cmap']
+interaction_key_list = ['bonds', 'pairs', 'angles', 'dihedrals', 'impropers']
+
+@functools.lru_cache(maxsize=None)
+def read_rtp(ff_dir: str = forcefield_dir) -> dict:
+    # {residue name: {section: [fields of every line]}} of all .rtp files of the force field
+    residue_dict = {}
+    for fname in sorted(glob.glob(os.path.join(ff_dir, '*.rtp'))):
+        residue, section = None, None
+        with open(fname) as handle:
+            for line in handle:
+                line = line.split(';')[0].strip()
+                if line == '':
+                    continue
+                if line.startswith('['):
+                    name = line.strip('[] ')
+                    if name in rtp_section_list:
+                        section = name
+                        if residue is not None:
+                            residue.setdefault(section, [])
+                    else:
+                        residue, section = (None if name == 'bondedtypes' else {}), None
+                        if residue is not None:
+                            residue_dict[name] = residue
+                elif residue is not None and section is not None:
+                    residue[section].append(line.split())
+    return residue_dict
+
+@functools.lru_cache(maxsize=None)
+def read_atom_type_mass(ff_dir: str = forcefield_dir) -> dict:
+    atom_type_mass = {}
+    with open(os.path.join(ff_dir, 'atomtypes.atp')) as handle:
+        for line in handle:
+            fields = line.split(';')[0].split()
+            if len(fields) >= 2:
+                atom_type_mass[fields[0]] = float(fields[1])
+    return atom_type_mass
+
+def get_chain_structure(monomer: dict, monomer_count: int) -> dict:
+    polymer, polymer_remove_atom_mask = get_polymer_skeleton(monomer, monomer_count)
+    return select_structure(polymer, np.flatnonzero(~polymer_remove_atom_mask))
+
+def get_generated_interactions(bond: np.array, atom_count: int) -> dict:
+    # angles, proper dihedrals and 1-4 pairs of a bond graph, as pdb2gmx generates them
+    neighbor_list = [[] for _ in range(atom_count)]
+    for iatom, jatom in bond.tolist():
+        neighbor_list[iatom].append(jatom)
+        neighbor_list[jatom].append(iatom)
+    neighbor_list = [sorted(neighbor) for neighbor in neighbor_list]
+
+    angle = [(iatom, jatom, katom) for jatom, neighbor in enumerate(neighbor_list)
+             for ineighbor, iatom in enumerate(neighbor) for katom in neighbor[ineighbor + 1:]]
+    dihedral = [(iatom, jatom, katom, latom) for jatom, katom in bond.tolist()
+                for iatom in neighbor_list[jatom] if iatom != katom
+                for latom in neighbor_list[katom] if latom != jatom and latom != iatom]
+
+    # 1-4 pairs that are not also 1-2 or 1-3 neighbours (rings)
+    exclusion = {tuple(sorted(pair)) for pair in bond.tolist()} | {(min(i, k), max(i, k)) for i, _, k in angle}
+    pair = sorted({(min(i, l), max(i, l)) for i, _, _, l in dihedral} - exclusion)
+
+    return {'pairs': np.array(pair, dtype=np.int64).reshape(-1, 2),
+            'angles': np.array(angle, dtype=np.int64).reshape(-1, 3),
+            'dihedrals': np.array(dihedral, dtype=np.int64).reshape(-1, 4)}
+
+def get_explicit_topology(chain: dict, rtp_dict: dict, atom_type_mass: dict) -> dict:
+    # topology of a (short) chain, atom by atom from the rtp entries of its residues
+    atom_name = get_column(chain, 'atom_name', np.arange(len(chain['coord'])))
+    residue_name = get_column(chain, 'residue_name', np.arange(len(chain['coord'])))
+    residue_index = chain['residue_seq_num'] - chain['residue_seq_num'].min()
+    residue_count = int(residue_index.max()) + 1
+    atom_lookup = {(residue, name): iatom for iatom, (residue, name) in enumerate(zip(residue_index.tolist(), atom_name.tolist()))}
+
+    def resolve(residue: int, name: str) -> int:
+        # '-CB' is CB of the previous residue, '+CA' is CA of the next one
+        residue += {'-': -1, '+': 1}.get(name[0], 0)
+        if residue < 0 or residue >= residue_count:
+            return None
+        iatom = atom_lookup.get((residue, name.lstrip('-+')))
+        if iatom is None:
+            raise Exception(f'ERROR: atom {name} of residue {residue + 1} is not in the polymer structure')
+        return iatom
+
+    residue_start = np.flatnonzero(np.r_[True, residue_index[1:] != residue_index[:-1]])
+    atom_type, charge, charge_group = [], [], []
+    bond, improper, improper_macro = set(), [], []
+    for residue, start in enumerate(residue_start.tolist()):
+        if residue_name[start] not in rtp_dict:
+            raise Exception(f'ERROR: residue {residue_name[start]} is not in the residue topology database')
+        rtp = rtp_dict[residue_name[start]]
+        rtp_atom = {fields[0]: fields for fields in rtp.get('atoms', [])}
+
+        residue_atom = np.flatnonzero(residue_index == residue)
+        for iatom in residue_atom.tolist():
+            if atom_name[iatom] not in rtp_atom:
+                raise Exception(f'ERROR: atom {atom_name[iatom]} is not in the residue topology of {residue_name[start]}')
+            fields = rtp_atom[atom_name[iatom]]
+            atom_type.append(fields[1])
+            charge.append(float(fields[2]))
+            charge_group.append((residue, int(fields[3])))
+
+        for fields in rtp.get('bonds', []):
+            atom_pair = [resolve(residue, name) for name in fields[:2]]
+            if None not in atom_pair:
+                bond.add(tuple(sorted(atom_pair)))
+        for fields in rtp.get('impropers', []):
+            atom_quad = [resolve(residue, name) for name in fields[:4]]
+            if None not in atom_quad:
+                improper.append(atom_quad)
+                improper_macro.append(' '.join(fields[4:]))
+
+    # charge groups are numbered through the chain in order of appearance
+    _, charge_group_first, charge_group_code = np.unique(np.array(charge_group), axis=0, return_index=True, return_inverse=True)
+    charge_group_number = np.argsort(np.argsort(charge_group_first))[charge_group_code.ravel()] + 1
+
+    bond = np.array(sorted(bond), dtype=np.int64).reshape(-1, 2)
+    topology = {'atom_name': atom_name,
+                'residue_name': residue_name,
+                'residue_index': residue_index,
+                'atom_type': np.array(atom_type),
+                'charge': np.array(charge),
+                'mass': np.array([atom_type_mass[name] for name in atom_type]),
+                'charge_group': charge_group_number,
+                'heavy_atom': get_column(chain, 'element', np.arange(len(chain['coord']))) != 'H',
+                'bonds': bond,
+                'impropers': np.array(improper, dtype=np.int64).reshape(-1, 4),
+                'improper_macro': np.array(improper_macro, dtype=object)}
+    topology.update(get_generated_interactions(bond, len(atom_name)))
+    return topology
+
+def get_residue_span(topology: dict) -> int:
+    # largest number of residues an interaction reaches beyond its first residue
+    residue_index = topology['residue_index']
+    return max([int((residue_index[topology[key]].max(axis=1) - residue_index[topology[key]].min(axis=1)).max(initial=0))
+                for key in interaction_key_list])
+
+def get_chain_topology(monomer: dict, monomer_count: int, ff_dir: str = forcefield_dir) -> dict:
+    rtp_dict, atom_type_mass = read_rtp(ff_dir), read_atom_type_mass(ff_dir)
+
+    # short chain with enough repeating units that one of them only reaches other repeating units
+    template_count = 5
+    while True:
+        template = get_explicit_topology(get_chain_structure(monomer, template_count), rtp_dict, atom_type_mass)
+        residue_span = get_residue_span(template)
+        if residue_span + 3 <= template_count:
+            break
+        template_count = residue_span + 5
+    if monomer_count <= template_count:
+        return get_explicit_topology(get_chain_structure(monomer, monomer_count), rtp_dict, atom_type_mass)
+
+    residue_index = template['residue_index']
+    head_atom_count = int((residue_index == 0).sum())
+    repeat_atom_count = int((residue_index == 1).sum())
+    repeat_count = monomer_count - 2 - residue_span
+    chain_shift = (monomer_count - template_count) * repeat_atom_count
+
+    # per-atom columns: starting unit, repeating unit (monomer_count - 2) times, end unit
+    atom_residue = np.concatenate([np.zeros(head_atom_count, dtype=np.int64),
+                                   np.repeat(np.arange(1, monomer_count - 1), repeat_atom_count),
+                                   np.full(int((residue_index == template_count - 1).sum()), monomer_count - 1)])
+    template_atom = np.concatenate([np.arange(head_atom_count),
+                                    np.tile(np.arange(head_atom_count, head_atom_count + repeat_atom_count), monomer_count - 2),
+                                    np.flatnonzero(residue_index == template_count - 1)])
+    topology = {key: template[key][template_atom] for key in ['atom_name', 'residue_name', 'atom_type', 'charge', 'mass', 'heavy_atom']}
+    topology['residue_index'] = atom_residue
+
+    # charge groups of the repeating and end units are shifted by the groups of the skipped repeating units
+    head_group_count = template['charge_group'][:head_atom_count].max()
+    repeat_group_count = template['charge_group'][residue_index == 1].max() - head_group_count
+    repeat_shift = np.where(atom_residue == monomer_count - 1, monomer_count - template_count, np.maximum(atom_residue - 1, 0))
+    topology['charge_group'] = template['charge_group'][template_atom] + repeat_shift * repeat_group_count
+
+    # interactions of the first residue, of one repeating unit copied along the chain, and of the chain end
+    for key in interaction_key_list + ['improper_macro']:
+        index_key = 'impropers' if key == 'improper_macro' else key
+        owner = residue_index[template[index_key]].min(axis=1) if len(template[index_key]) > 0 else np.zeros(0, dtype=np.int64)
+        value = template[key]
+        if key == 'improper_macro':
+            topology[key] = np.concatenate([value[owner == 0],
+                                            np.tile(value[owner == 1], repeat_count),
+                                            value[owner >= template_count - 1 - residue_span]])
+            continue
+        repeat_shift = (np.arange(repeat_count) * repeat_atom_count)[:, None, None]
+        topology[key] = np.concatenate([value[owner == 0],
+                                        (value[owner == 1][None, :, :] + repeat_shift).reshape(-1, value.shape[1]),
+                                        value[owner >= template_count - 1 - residue_span] + chain_shift])
+    return topology
+
+def get_itp_content(topology: dict, molecule_name: str = 'Other', posre_fname: str = None) -> str:
+    atom_count = len(topology['atom_name'])
+    nr = np.arange(1, atom_count + 1)
+    section_list = ['[ moleculetype ]\n; Name            nrexcl\n%-15s %5d' % (molecule_name, nrexcl),
+                    '[ atoms ]\n;   nr       type  resnr residue  atom   cgnr     charge       mass\n' +
+                    format_rows('%6d %10s %6d %6s %6s %6d %10g %10g',
+                                [nr, topology['atom_type'], topology['residue_index'] + 1, topology['residue_name'],
+                                 topology['atom_name'], topology['charge_group'], topology['charge'], topology['mass']])]
+
+    for key, funct, header in [('bonds', bond_funct, ';  ai    aj funct'),
+                               ('pairs', pair_funct, ';  ai    aj funct'),
+                               ('angles', angle_funct, ';  ai    aj    ak funct'),
+                               ('dihedrals', dihedral_funct, ';  ai    aj    ak    al funct')]:
+        index = topology[key] + 1
+        rows = format_rows(' '.join(['%5d'] * (index.shape[1] + 1)),
+                           [index[:, icolumn] for icolumn in range(index.shape[1])] + [np.full(len(index), funct)])
+        section_list.append(f'[ {key} ]\n{header}\n{rows}')
+
+    if len(topology['impropers']) > 0:
+        index = topology['impropers'] + 1
+        rows = format_rows('%5d %5d %5d %5d %5d    %s', [index[:, 0], index[:, 1], index[:, 2], index[:, 3],
+                                                         np.full(len(index), improper_funct), topology['improper_macro']])
+        section_list.append(f'[ dihedrals ]\n;  ai    aj    ak    al funct\n{rows}')
+
+    if posre_fname is not None:
+        section_list.append(f'; Include Position restraint file\n#ifdef POSRES\n#include "{posre_fname}"\n#endif')
+    return '\n\n'.join(section_list) + '\n'
+
+def get_posre_content(topology: dict) -> str:
+    # heavy atoms only, like pdb2gmx
+    nr = np.flatnonzero(topology['heavy_atom']) + 1
+    force = np.full(len(nr), position_restraint_force)
+    return ('[ position_restraints ]\n; atom  type      fx      fy      fz\n' +
+            format_rows('%6d %5d %7d %7d %7d', [nr, np.ones(len(nr), dtype=np.int64), force, force, force]) + '\n')
+
+def get_top_content(itp_content: str, molecule_name: str = 'Other', molecule_count: int = 1) -> str:
+    # stand-alone topology in the layout of pdb2gmx -water spce
+    return '\n'.join([
+        '; Include forcefield parameters',
+        '#include "oplsaa.ff/forcefield.itp"',
+        '',
+        itp_content,
+        '; Include water topology',
+        '#include "oplsaa.ff/spce.itp"',
+        '',
+        '; Include topology for ions',
+        '#include "oplsaa.ff/ions.itp"',
+        '',
+        '[ system ]',
+        '; Name',
+        'Polymer',
+        '',
+        '[ molecules ]',
+        '; Compound        #mols',
+        '%-15s %5d' % (molecule_name, molecule_count),
+        '',
+    ])
+
+@calcfunction
+def get_polymer_topology(monomer: SinglefileData, polymer_connection_point_list: List, monomer_count: Int,
+                         top_filename: Str = None, posre_filename: Str = None) -> dict:
+    '''
+    topol.top and posre.itp of one chain of the PolymerizeWorkChain polymer, in place of gmx pdb2gmx.
+    The molecule is called Other like in the pdb2gmx output, so convert_top_to_itp keeps working.
+    '''
+    top_filename = top_filename if top_filename is not None else Str('topol.top')
+    posre_filename = posre_filename if posre_filename is not None else Str('posre.itp')
+
+    monomer = get_monomer_template(monomer.get_content(), polymer_connection_point_list.get_list())
+    topology = get_chain_topology(monomer, monomer_count.value)
+    itp_content = get_itp_content(topology, 'Other', posre_filename.value)
+
+    return {
+        'top': SinglefileData.from_string(get_top_content(itp_content), filename=top_filename.value),
+        'posre': SinglefileData.from_string(get_posre_content(topology), filename=posre_filename.value),
+    }
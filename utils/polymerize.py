@@ -1,69 +1,32 @@
 import os
+import functools
 import numpy as np
 import pandas as pd
-import copy
-
-from aiida.orm import Int, Float, Str, List, Dict, ArrayData, SinglefileData
-from aiida.engine import WorkChain
-
-def get_atom_lines(lines) -> list:
-    return [line for line in lines if line.startswith('ATOM') or line.startswith('HETATM')]
-
-def get_atom_dict(num: int, line: str) -> dict:
-    return {'atom_number': num, 
-            'atom_name': line[12:16].split()[0], 
-            'residue_name': line[17:20].split()[0], 
-            'residue_seq_num': int(line[22:26].split()[0]), 
-            'coord': [float(line[30:38].split()[0]), 
-                      float(line[38:46].split()[0]), 
-                      float(line[46:54].split()[0])], 
-            'element': line[76:78].split()[0]}
-
-def copy_atomdict(curratom_dict: dict) -> dict:
-    return copy.deepcopy(curratom_dict)
-
-def update_atom_number(curratom_dict: dict, atom_number: int) -> dict:
-    return {'atom_number': atom_number, 
-            'atom_name': curratom_dict['atom_name'], 
-            'residue_name': curratom_dict['residue_name'], 
-            'residue_seq_num': curratom_dict['residue_seq_num'], 
-            'coord': curratom_dict['coord'], 
-            'element': curratom_dict['element']}
-
-def update_residue_seq_num(curratom_dict: dict, residue_seq_num: int) -> dict:
-    return {'atom_number': curratom_dict['atom_number'], 
-            'atom_name': curratom_dict['atom_name'], 
-            'residue_name': curratom_dict['residue_name'], 
-            'residue_seq_num': residue_seq_num, 
-            'coord': curratom_dict['coord'], 
-            'element': curratom_dict['element']}
-
-def update_residue_name(curratom_dict: dict, residue_name: str) -> dict:
-    return {'atom_number': curratom_dict['atom_number'], 
-            'atom_name': curratom_dict['atom_name'], 
-            'residue_name': residue_name, 
-            'residue_seq_num': curratom_dict['residue_seq_num'], 
-            'coord': curratom_dict['coord'], 
-            'element': curratom_dict['element']}
-
-def update_coord(curratom_dict: dict, coord: list) -> dict:
-    return {'atom_number': curratom_dict['atom_number'], 
-            'atom_name': curratom_dict['atom_name'], 
-            'residue_name': curratom_dict['residue_name'], 
-            'residue_seq_num': curratom_dict['residue_seq_num'], 
-            'coord': coord, 
-            'element': curratom_dict['element']}
-
-def get_pdbstr(curratom_dict: dict) -> str:
-    pdb_str = "ATOM  %5d %-4s %3s  %4d    %8.3f%8.3f%8.3f                      %2s" % (curratom_dict['atom_number']+1, 
-                                                                                       curratom_dict['atom_name'], 
-                                                                                       curratom_dict['residue_name'], 
-                                                                                       curratom_dict['residue_seq_num']+1, 
-                                                                                       curratom_dict['coord'][0], 
-                                                                                       curratom_dict['coord'][1], 
-                                                                                       curratom_dict['coord'][2], 
-                                                                                       curratom_dict['element'])
-    return pdb_str
+
+from aiida.orm import Bool, Int, Float, Str, List, Dict, ArrayData, SinglefileData
+from aiida.engine import WorkChain, calcfunction
+
+from utils.structure_io import get_buffer, parse_pdb, select_structure, concatenate_structure, set_categorical, \
+                               get_structure_singlefile, read_structure_singlefile
+from utils.polymer_cache import get_cache_key, get_cached_polymer, get_cached_polymer_node, get_cached_polymer_binary, \
+                                set_cached_polymer_binary_uuid, store_cached_polymer
+from utils.polymer_constant import monomer_data_dir, pdb_dict, connection_point_dict
+from utils.cell_list import get_cell_list, add_cell_atom, pop_cell_atom, find_overlap
+
+elements_csv = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'elements.csv')
+
+def get_monomer_structure(content: str) -> dict:
+    return parse_pdb(get_buffer(content))
+
+def get_atom_count(structure: dict) -> int:
+    return len(structure['coord'])
+
+def get_atom_name_code(structure: dict, atom_name: str) -> int:
+    code = np.flatnonzero(structure['atom_name_table'] == atom_name)
+    return int(code[0]) if len(code) > 0 else -1
+
+def get_atom_index(structure: dict, atom_name: str) -> np.array:
+    return np.flatnonzero(structure['atom_name'] == get_atom_name_code(structure, atom_name))
 
 def get_unit_vector(pos1: np.array, pos2: np.array) -> np.array:
 
@@ -103,11 +66,655 @@ def rotate_coord(atom_coord: np.array, ref_coord: np.array, rotation_matrix: np.
 
     ref_atom_vec = atom_coord - ref_coord
     
-    rotated_coord_vec = np.dot(rotation_matrix, ref_atom_vec)
+    # works on a single coordinate or an (n_atoms, 3) block
+    rotated_coord_vec = ref_atom_vec @ rotation_matrix.T
     new_atom_coord = ref_coord + rotated_coord_vec
 
     return new_atom_coord
 
+def get_polymer_residue_name_table(residue_name_table: np.array) -> np.array:
+    # residue names of the starting, repeating and end unit (e.g. BD1, BD2, BD3)
+    stem_list = [name[:-1] for name in residue_name_table]
+    return np.array(list(residue_name_table) + 
+                    [stem + '2' for stem in stem_list] + 
+                    [stem + '3' for stem in stem_list])
+
+def get_monomer_template(content: str, polymer_connection_point_list: list) -> dict:
+    monomer = get_monomer_structure(content)
+
+    #['CW', 'HW3', 'HA3', 'CA']
+    connection_point_index = []
+    for atom_name in polymer_connection_point_list:
+        atom_index = get_atom_index(monomer, atom_name)
+        if len(atom_index) == 0:
+            raise ValueError(f'{atom_name} atom is not found.')
+        connection_point_index.append(atom_index[0])
+    monomer['connection_point_index'] = np.array(connection_point_index)
+    monomer['hw3_index'] = get_atom_index(monomer, polymer_connection_point_list[1])
+    monomer['ha3_index'] = get_atom_index(monomer, polymer_connection_point_list[2])
+
+    # get coordinate of connection point (lies on CA-HA3 vector with a CA-Connection point distance of 1.58)
+    pos1 = monomer['coord'][connection_point_index[2]]
+    pos2 = monomer['coord'][connection_point_index[3]]
+    ca_ha3_unit_vec = get_unit_vector(pos1, pos2)
+    monomer['ha3_coord'] = pos2 + ca_ha3_unit_vec * 1.58
+
+    return monomer
+
+def get_axis_rotation_matrix(rotation_axis: np.array, rotation_angle: np.array) -> np.array:
+    # Rodrigues rotation about one axis (or one axis per angle) for an array of angles -> (n_angles, 3, 3)
+    rotation_angle = np.asarray(rotation_angle, dtype=np.float64)
+    cos_angle = np.cos(rotation_angle)[..., None, None]
+    sin_angle = np.sin(rotation_angle)[..., None, None]
+
+    # cross_matrix @ v == rotation_axis x v
+    rotation_axis = np.asarray(rotation_axis, dtype=np.float64)
+    cross_matrix = np.swapaxes(np.cross(rotation_axis[..., None, :], np.eye(3)), -1, -2)
+
+    return np.eye(3) + sin_angle * cross_matrix + (1 - cos_angle) * (cross_matrix @ cross_matrix)
+
+def get_batch_skeleton(monomer: dict, chain_length_list) -> tuple:
+    # residues of all chains back to back, residue_seq_num runs on across chains
+    chain_length_list = np.asarray(chain_length_list, dtype=np.int64)
+    monomer_atom_count = get_atom_count(monomer)
+    residue_count = int(chain_length_list.sum())
+
+    chain_index = np.repeat(np.arange(len(chain_length_list)), chain_length_list)
+    chain_start = np.cumsum(chain_length_list) - chain_length_list
+    chain_residue_index = np.arange(residue_count) - chain_start[chain_index]
+    chain_length = chain_length_list[chain_index]
+
+    # 0 -> starting unit, 1 -> repeating unit, 2 -> end unit
+    residue_kind = np.ones(residue_count, dtype=np.int16)
+    residue_kind[chain_residue_index == 0] = 0
+    residue_kind[(chain_residue_index == chain_length - 1) & (chain_length > 1)] = 2
+
+    polymer = {'atom_name_table': monomer['atom_name_table'], 
+               'atom_name': np.tile(monomer['atom_name'], residue_count), 
+               'residue_name_table': get_polymer_residue_name_table(monomer['residue_name_table']), 
+               'residue_name': np.tile(monomer['residue_name'], residue_count) + 
+                               np.repeat(residue_kind, monomer_atom_count) * len(monomer['residue_name_table']), 
+               'residue_seq_num': np.repeat(np.arange(residue_count, dtype=np.int32), monomer_atom_count), 
+               'coord': np.empty((monomer_atom_count * residue_count, 3)), 
+               'element_table': monomer['element_table'], 
+               'element': np.tile(monomer['element'], residue_count)}
+
+    # HW3 is removed from all but the last monomer, HA3 from all but the first one
+    polymer_remove_atom_mask = np.zeros((residue_count, monomer_atom_count), dtype=bool)
+    polymer_remove_atom_mask[np.ix_(chain_residue_index == 0, monomer['hw3_index'])] = True
+    polymer_remove_atom_mask[np.ix_(chain_residue_index > 0, monomer['ha3_index'])] = True
+    polymer_remove_atom_mask[np.ix_((chain_residue_index > 0) & (chain_residue_index < chain_length - 1), monomer['hw3_index'])] = True
+
+    return polymer, polymer_remove_atom_mask.ravel(), chain_residue_index
+
+def get_polymer_skeleton(monomer: dict, monomer_count: int) -> tuple:
+    polymer, polymer_remove_atom_mask, _ = get_batch_skeleton(monomer, [monomer_count])
+    return polymer, polymer_remove_atom_mask
+
+def place_monomer_stepwise(polymer: dict, monomer: dict, monomer_count: int):
+    cw_index, hw3_index, ha3_index, ca_index = monomer['connection_point_index']
+    monomer_atom_count = get_atom_count(monomer)
+
+    # first monomer
+    polymer['coord'][:monomer_atom_count] = monomer['coord']
+
+    # Add monomers to the polymer chain
+    for imonomer in range(1, monomer_count):
+        prev_start = (imonomer - 1) * monomer_atom_count
+        start = prev_start + monomer_atom_count
+        end = start + monomer_atom_count
+
+        # CW and HW3 of last monomer, CA of the new monomer
+        dtranslate = polymer['coord'][prev_start + cw_index] - monomer['ha3_coord']
+
+        # put the next monomer in the polymer + translation
+        polymer['coord'][start:end] = monomer['coord'] + dtranslate
+
+        # rotation starts here
+        # CW.coord == HA3.coord
+        pos1 = polymer['coord'][prev_start + hw3_index]
+        pos2 = polymer['coord'][prev_start + cw_index]
+        cw_hw3_unit_vec = get_unit_vector(pos1, pos2)
+
+        pos1 = polymer['coord'][start + ca_index]
+        cw_ca_unit_vec = get_unit_vector(pos1, pos2)
+
+        rotation_matrix = get_rotation_matrix(cw_hw3_unit_vec, cw_ca_unit_vec)
+
+        polymer['coord'][start:end] = rotate_coord(polymer['coord'][start:end], pos2, rotation_matrix)
+
+def place_monomer_transform(polymer: dict, monomer: dict, monomer_count: int):
+    cw_index, hw3_index, ha3_index, ca_index = monomer['connection_point_index']
+
+    # per-repeat rigid-body step x -> S x + t, derived once in the monomer frame:
+    # HA3 site goes onto CW and the CA direction is aligned to the CW-HW3 bond
+    cw_hw3_unit_vec = get_unit_vector(monomer['coord'][hw3_index], monomer['coord'][cw_index])
+    cw_ca_unit_vec = get_unit_vector(monomer['coord'][ca_index], monomer['ha3_coord'])
+
+    rotation_angle = np.arccos(np.dot(cw_hw3_unit_vec, cw_ca_unit_vec))
+    rotation_axis = np.cross(cw_ca_unit_vec, cw_hw3_unit_vec)
+    rotation_axis /= np.linalg.norm(rotation_axis)
+
+    # cumulative transforms: S^i = rotation by i * angle, b_i = sum_{k < i} S^k t
+    rotation_matrix_list = get_axis_rotation_matrix(rotation_axis, np.arange(monomer_count) * rotation_angle)
+    rotation_matrix = get_rotation_matrix(cw_hw3_unit_vec, cw_ca_unit_vec)
+    translation = monomer['coord'][cw_index] - rotation_matrix @ monomer['ha3_coord']
+    translation_list = np.zeros((monomer_count, 3))
+    translation_list[1:] = np.cumsum(rotation_matrix_list[:-1] @ translation, axis=0)
+
+    coord = np.einsum('nij,aj->nai', rotation_matrix_list, monomer['coord']) + translation_list[:, None, :]
+    polymer['coord'][:] = coord.reshape(-1, 3)
+
+# backbone torsion offsets from the all-trans step (trans, gauche+, gauche-) and their weights
+torsion_state_list = np.radians([0.0, 120.0, -120.0])
+torsion_state_probability = np.array([0.6, 0.2, 0.2])
+torsion_jitter = np.radians(10.0)
+
+# states per monomer (template residue name without its position digit), calibrated so that random-walk
+# 200-mers come within about 20 % of the melt Rg from C_inf; only the link torsion is sampled, and in the rigid
+# trans-butadiene repeat the default states give chains about twice the melt size
+torsion_state_dict = {
+    'BD': (np.radians([0.0, 60.0, -60.0]), np.array([0.8, 0.1, 0.1])),
+    'VA': (torsion_state_list, torsion_state_probability),
+    'MA': (torsion_state_list, torsion_state_probability),
+    'IP': (torsion_state_list, torsion_state_probability),
+    'JS': (torsion_state_list, torsion_state_probability),
+}
+
+# growth is checked against atoms of non-adjacent monomers closer than overlap_cutoff (Angstrom)
+overlap_cutoff = 1.6
+max_torsion_retry = 8
+max_trial_per_residue = 100
+
+def get_torsion_state(monomer: dict) -> tuple:
+    residue_name = monomer['residue_name_table'][monomer['residue_name'][0]][:-1]
+    if residue_name not in torsion_state_dict:
+        print(f'Warning: torsion states of {residue_name} are not calibrated, random-walk chains may not have the size of the melt.')
+        return torsion_state_list, torsion_state_probability
+    return torsion_state_dict[residue_name]
+
+def get_torsion_angle_list(residue_count: int, seed: int = 0, state_list: np.array = torsion_state_list, 
+                           state_probability: np.array = torsion_state_probability) -> np.array:
+    # one torsion per residue (the first one is unused), drawn row by row so a longer chain keeps the same start
+    draw = np.random.default_rng(seed).random((residue_count, 2))
+    state = np.minimum(np.searchsorted(np.cumsum(state_probability), draw[:, 0], side='right'), len(state_list) - 1)
+    return state_list[state] + (2 * draw[:, 1] - 1) * torsion_jitter
+
+def get_pair_transform(prev_monomer: dict, monomer: dict) -> tuple:
+    # rigid step x -> R x + t that puts monomer after prev_monomer, both in their own template frame
+    cw_index, hw3_index, _, _ = prev_monomer['connection_point_index']
+    ca_index = monomer['connection_point_index'][3]
+    cw_hw3_unit_vec = get_unit_vector(prev_monomer['coord'][hw3_index], prev_monomer['coord'][cw_index])
+    cw_ca_unit_vec = get_unit_vector(monomer['coord'][ca_index], monomer['ha3_coord'])
+    rotation_matrix = get_rotation_matrix(cw_hw3_unit_vec, cw_ca_unit_vec)
+    return rotation_matrix, prev_monomer['coord'][cw_index] - rotation_matrix @ monomer['ha3_coord']
+
+def get_torsion_axis(prev_monomer: dict) -> tuple:
+    # the new CW-CA bond lies along CW-HW3 of prev_monomer
+    cw_index, hw3_index, _, _ = prev_monomer['connection_point_index']
+    return get_unit_vector(prev_monomer['coord'][hw3_index], prev_monomer['coord'][cw_index]), prev_monomer['coord'][cw_index]
+
+def accumulate_transform(step_rotation_matrix: np.array, step_translation: np.array, chain_start: np.array) -> tuple:
+    # T_i = T_{i-1} o step_i, restarting from the identity at every chain start; only 3x3 work per residue
+    residue_count = len(chain_start)
+    step_rotation_matrix = np.broadcast_to(step_rotation_matrix, (residue_count, 3, 3))
+    step_translation = np.broadcast_to(step_translation, (residue_count, 3))
+    rotation_matrix_list = np.empty((residue_count, 3, 3))
+    translation_list = np.empty((residue_count, 3))
+    for iresidue in range(residue_count):
+        if chain_start[iresidue]:
+            rotation_matrix_list[iresidue] = np.eye(3)
+            translation_list[iresidue] = 0.0
+        else:
+            rotation_matrix_list[iresidue] = rotation_matrix_list[iresidue - 1] @ step_rotation_matrix[iresidue]
+            translation_list[iresidue] = rotation_matrix_list[iresidue - 1] @ step_translation[iresidue] + translation_list[iresidue - 1]
+    return rotation_matrix_list, translation_list
+
+def grow_random_walk(monomer_list: list, sequence_index: np.array, chain_start: np.array, seed: int = 0, 
+                     cutoff: float = overlap_cutoff, max_retry: int = max_torsion_retry, 
+                     start_transform: tuple = None, start_coord: np.array = None, start_torsion_angle: float = None) -> np.array:
+    '''
+    Grow chains monomer by monomer with a random RIS torsion at every link and return the coordinates of all residues.
+    Placed atoms go into a cell list and every new monomer is checked against all monomers but its bonded neighbour.
+    On overlap the torsion is redrawn uniformly, after max_retry failures the previous link is redrawn as well (backtracking),
+    and once the trial budget is spent the placement with the fewest overlaps is kept.
+    HW3/HA3 are left out of the check as they are replaced at the links.
+    To continue an existing chain, start_transform places the first residue (the one before the old end) and
+    start_coord holds the existing atoms before it, which seed the cell list and are never moved.
+    The old end is grown again as the second residue, with start_torsion_angle as its first trial.
+    '''
+    sequence_index = np.asarray(sequence_index).tolist()
+    residue_count = len(sequence_index)
+    # the same draws for every monomer, mapped onto the states of the monomer at each residue
+    torsion_angle_table = np.array([get_torsion_angle_list(residue_count, seed, *get_torsion_state(monomer)) for monomer in monomer_list])
+    torsion_angle = torsion_angle_table[sequence_index, np.arange(residue_count)]
+    if start_torsion_angle is not None:
+        torsion_angle[1] = start_torsion_angle
+    retry_rng = np.random.default_rng([seed, 1])
+    check_mask_list = [~np.isin(np.arange(get_atom_count(monomer)), np.concatenate([monomer['hw3_index'], monomer['ha3_index']])) 
+                       for monomer in monomer_list]
+    torsion_axis_list = [get_torsion_axis(monomer) for monomer in monomer_list]
+    pair_transform = {pair: get_pair_transform(monomer_list[pair[0]], monomer_list[pair[1]]) 
+                      for pair in set(zip(sequence_index[:-1], sequence_index[1:]))}
+
+    rotation_matrix_list = np.empty((residue_count, 3, 3))
+    translation_list = np.empty((residue_count, 3))
+    coord_list = [None] * residue_count
+    overlap_count_list = np.zeros(residue_count, dtype=np.int64)
+    attempt_count = np.zeros(residue_count, dtype=np.int64)
+    max_trial_count = max_trial_per_residue * residue_count
+    trial_count = 0
+    best = None
+
+    iresidue = 0
+    while iresidue < residue_count:
+        index = sequence_index[iresidue]
+        monomer = monomer_list[index]
+        if chain_start[iresidue]:
+            cell_list = get_cell_list(cutoff)
+            first_residue = iresidue
+            if iresidue == 0 and start_transform is not None:
+                rotation_matrix_list[iresidue], translation_list[iresidue] = start_transform
+                coord_list[iresidue] = monomer['coord'] @ rotation_matrix_list[iresidue].T + translation_list[iresidue]
+                if start_coord is not None:
+                    add_cell_atom(cell_list, start_coord)
+            else:
+                rotation_matrix_list[iresidue] = np.eye(3)
+                translation_list[iresidue] = 0.0
+                coord_list[iresidue] = monomer['coord'].copy()
+            iresidue += 1
+            continue
+
+        prev_index = sequence_index[iresidue - 1]
+        pair_rotation_matrix, pair_translation = pair_transform[(prev_index, index)]
+        torsion_axis, torsion_point = torsion_axis_list[prev_index]
+        angle = torsion_angle[iresidue] if attempt_count[iresidue] == 0 else retry_rng.uniform(-np.pi, np.pi)
+        attempt_count[iresidue] += 1
+        trial_count += 1
+
+        torsion_matrix = get_axis_rotation_matrix(torsion_axis, angle)
+        prev_rotation_matrix, prev_translation = rotation_matrix_list[iresidue - 1], translation_list[iresidue - 1]
+        trial_rotation_matrix = prev_rotation_matrix @ torsion_matrix @ pair_rotation_matrix
+        trial_translation = prev_rotation_matrix @ (torsion_matrix @ (pair_translation - torsion_point) + torsion_point) + prev_translation
+        trial_coord = monomer['coord'] @ trial_rotation_matrix.T + trial_translation
+        overlap_count = int(find_overlap(cell_list, trial_coord[check_mask_list[index]]).sum())
+        if best is None or overlap_count < best[0]:
+            best = (overlap_count, trial_rotation_matrix, trial_translation, trial_coord)
+
+        # the residue before the old end of a continued chain cannot be redrawn, so its link gets the whole per-residue budget
+        link_max_retry = max_trial_per_residue if start_transform is not None and iresidue == 1 else max_retry
+        if overlap_count > 0 and trial_count < max_trial_count:
+            if attempt_count[iresidue] <= link_max_retry:
+                continue
+            if iresidue - 1 > first_residue:
+                # take monomers off again until one with retries left, the cell list then holds the monomers before its neighbour
+                best = None
+                while True:
+                    attempt_count[iresidue] = 0
+                    iresidue -= 1
+                    pop_cell_atom(cell_list, coord_list[iresidue - 1][check_mask_list[sequence_index[iresidue - 1]]])
+                    if attempt_count[iresidue] <= max_retry or iresidue - 1 == first_residue:
+                        break
+                continue
+
+        overlap_count_list[iresidue], rotation_matrix_list[iresidue], translation_list[iresidue], coord_list[iresidue] = best
+        best = None
+        # the bonded neighbour joins the cell list only now, so it is never checked against this monomer
+        add_cell_atom(cell_list, coord_list[iresidue - 1][check_mask_list[prev_index]])
+        iresidue += 1
+
+    unresolved_count = np.count_nonzero(overlap_count_list)
+    if unresolved_count > 0:
+        print(f'Warning: {unresolved_count} monomers still overlap after {trial_count} torsion trials.')
+    return np.concatenate(coord_list)
+
+def get_random_walk_coord(monomer: dict, chain_residue_index: np.array, seed: int = 0) -> np.array:
+    # (residue, atom, xyz) coordinates, a new chain starts wherever chain_residue_index is 0
+    coord = grow_random_walk([monomer], np.zeros(len(chain_residue_index), dtype=np.int64), chain_residue_index == 0, seed)
+    return coord.reshape(len(chain_residue_index), get_atom_count(monomer), 3)
+
+def place_monomer_random_walk(polymer: dict, monomer: dict, monomer_count: int, seed: int = 0):
+    polymer['coord'][:] = get_random_walk_coord(monomer, np.arange(monomer_count), seed).reshape(-1, 3)
+
+@functools.lru_cache(maxsize=None)
+def get_element_mass_dict(fname: str = elements_csv) -> dict:
+    dataframe_elements = pd.read_csv(fname, index_col = None)
+    return dict(zip(dataframe_elements['Symbol'], dataframe_elements['AtomicMass'].astype(float)))
+
+def get_atom_mass(structure: dict, element_mass_dict: dict = None) -> np.array:
+    element_mass_dict = element_mass_dict if element_mass_dict is not None else get_element_mass_dict()
+    return np.array([element_mass_dict[element] for element in structure['element_table']])[structure['element']]
+
+def calc_polymer_molecular_weight(monomer: dict, monomer_count, element_mass_dict: dict = None):
+    # count * monomer mass - removed HW3 (all but the last monomer, at least one) - removed HA3 (all but the first monomer)
+    atom_mass = get_atom_mass(monomer, element_mass_dict)
+
+    monomer_count = np.asarray(monomer_count)
+    hw3_remove_count = np.maximum(monomer_count - 1, 1)
+    ha3_remove_count = monomer_count - 1
+
+    return (monomer_count * atom_mass.sum() - 
+            hw3_remove_count * atom_mass[monomer['hw3_index']].sum() - 
+            ha3_remove_count * atom_mass[monomer['ha3_index']].sum())
+
+@calcfunction
+def get_polymer_molecular_weight(monomer: SinglefileData, polymer_connection_point_list: List, monomer_count: Int) -> Float:
+    monomer = get_monomer_template(monomer.get_content(), polymer_connection_point_list.get_list())
+    return Float(calc_polymer_molecular_weight(monomer, monomer_count.value))
+
+build_mode_dict = {
+    'stepwise': place_monomer_stepwise,
+    'transform': place_monomer_transform,
+    'random_walk': place_monomer_random_walk,
+}
+
+def build_polymer_structure(monomer: dict, monomer_count: int, build_mode: str = 'stepwise', seed: int = 0) -> tuple:
+    if build_mode not in build_mode_dict:
+        raise ValueError(f'Build mode {build_mode} is not available.')
+
+    polymer, polymer_remove_atom_mask = get_polymer_skeleton(monomer, monomer_count)
+    place_monomer = build_mode_dict[build_mode]
+    if build_mode == 'random_walk':
+        place_monomer = functools.partial(place_monomer, seed=seed)
+    place_monomer(polymer, monomer, monomer_count)
+
+    return polymer, polymer_remove_atom_mask
+
+chain_length_distribution_list = ['monodisperse', 'schulz-zimm', 'flory']
+
+def get_chain_length_list(chain_count: int, monomer_count: int, distribution: str = 'monodisperse', 
+                          dispersity: float = 2.0, seed: int = 0) -> np.array:
+    '''
+    Draw chain_count chain lengths with number-average monomer_count.
+    schulz-zimm: gamma distributed lengths with Mw/Mn = dispersity, flory: most probable distribution (Mw/Mn ~ 2).
+    '''
+    rng = np.random.default_rng(seed)
+    if distribution == 'monodisperse':
+        chain_length_list = np.full(chain_count, monomer_count)
+    elif distribution == 'schulz-zimm':
+        if dispersity <= 1:
+            raise ValueError(f'Dispersity must be larger than 1 for {distribution}, got {dispersity}.')
+        shape = 1 / (dispersity - 1)
+        chain_length_list = np.rint(rng.gamma(shape, monomer_count / shape, chain_count))
+    elif distribution == 'flory':
+        chain_length_list = rng.geometric(1 / monomer_count, chain_count)
+    else:
+        raise ValueError(f'Chain length distribution {distribution} is not available.')
+    return np.maximum(chain_length_list, 1).astype(np.int64)
+
+def build_polymer_batch(monomer: dict, chain_length_list, build_mode: str = 'stepwise', spacing: float = 5.0, seed: int = 0) -> tuple:
+    '''
+    Build all chains in one pass and shift each chain onto its own site of a cubic grid.
+    random_walk: every chain gets its own torsions, other modes: every chain is a prefix of the longest one,
+    so the coordinates are gathered per residue from a single build.
+    '''
+    chain_length_list = np.asarray(chain_length_list, dtype=np.int64)
+    monomer_atom_count = get_atom_count(monomer)
+    polymer, polymer_remove_atom_mask, chain_residue_index = get_batch_skeleton(monomer, chain_length_list)
+
+    if build_mode == 'random_walk':
+        coord = get_random_walk_coord(monomer, chain_residue_index, seed)
+    else:
+        longest_polymer, _ = build_polymer_structure(monomer, int(chain_length_list.max()), build_mode)
+        coord = longest_polymer['coord'].reshape(-1, monomer_atom_count, 3)[chain_residue_index]
+
+    # grid site size from the largest chain extent + spacing (Angstrom)
+    chain_start = np.cumsum(chain_length_list) - chain_length_list
+    chain_min = np.minimum.reduceat(coord.min(axis=1), chain_start)
+    chain_max = np.maximum.reduceat(coord.max(axis=1), chain_start)
+    site_length = (chain_max - chain_min).max(axis=0) + spacing
+    site_count = int(np.ceil(len(chain_length_list) ** (1 / 3)))
+    site_index = np.stack(np.unravel_index(np.arange(len(chain_length_list)), (site_count,) * 3), axis=1)
+    chain_translation = np.repeat(site_index * site_length - chain_min, chain_length_list, axis=0)
+
+    polymer['coord'] = (coord + chain_translation[:, None, :]).reshape(-1, 3)
+
+    return polymer, polymer_remove_atom_mask
+
+copolymer_sequence_type_list = ['block', 'alternating', 'random', 'explicit']
+
+def get_copolymer_sequence(monomer_id_list: list, monomer_count: int = None, sequence_type: str = 'block', 
+                           ratio: list = None, seed: int = 0) -> np.array:
+    '''
+    Monomer id of every residue along the chain.
+    block/random: monomer_count residues split by ratio (equal by default), alternating: ids in turn,
+    which fixes an equal ratio, explicit: monomer_id_list is the sequence itself.
+    '''
+    monomer_id_list = np.asarray(monomer_id_list)
+    if sequence_type == 'explicit':
+        return monomer_id_list
+    if monomer_count is None:
+        raise ValueError(f'Sequence type {sequence_type} needs a monomer count.')
+
+    ratio = np.ones(len(monomer_id_list)) if ratio is None else np.asarray(ratio, dtype=np.float64)
+    if len(ratio) != len(monomer_id_list) or np.any(ratio < 0) or ratio.sum() == 0:
+        raise ValueError(f'Ratio {ratio.tolist()} does not match monomers {monomer_id_list.tolist()}.')
+    if sequence_type == 'alternating' and np.any(ratio != ratio[0]):
+        raise ValueError(f'Ratio {ratio.tolist()} cannot be alternating, the monomers of an alternating sequence come in equal numbers.')
+    ratio = ratio / ratio.sum()
+
+    if sequence_type == 'block':
+        # largest remainder rounding keeps the total at monomer_count
+        block_length = np.floor(ratio * monomer_count).astype(np.int64)
+        remainder = monomer_count - block_length.sum()
+        block_length[np.argsort(block_length - ratio * monomer_count, kind='stable')[:remainder]] += 1
+        return np.repeat(monomer_id_list, block_length)
+    elif sequence_type == 'alternating':
+        return monomer_id_list[np.arange(monomer_count) % len(monomer_id_list)]
+    elif sequence_type == 'random':
+        return np.random.default_rng(seed).choice(monomer_id_list, monomer_count, p=ratio)
+    raise ValueError(f'Sequence type {sequence_type} is not available.')
+
+def build_copolymer_structure(monomer_list: list, sequence_index: np.array, seed: int = None) -> tuple:
+    '''
+    Build one chain of mixed monomers: sequence_index gives the position in monomer_list of every residue.
+    The templates share one table, atoms of every residue are gathered from it and placed with one einsum.
+    With a seed the chain is grown as in the random_walk build mode instead (random RIS torsions, overlap checked).
+    '''
+    sequence_index = np.asarray(sequence_index, dtype=np.int64)
+    residue_count = len(sequence_index)
+    template = concatenate_structure(monomer_list)
+    template_atom_count = np.array([get_atom_count(monomer) for monomer in monomer_list])
+    template_start = np.cumsum(template_atom_count) - template_atom_count
+
+    # table atoms of every residue
+    residue_atom_count = template_atom_count[sequence_index]
+    residue_index = np.repeat(np.arange(residue_count), residue_atom_count)
+    atom_offset = np.arange(len(residue_index)) - np.repeat(np.cumsum(residue_atom_count) - residue_atom_count, residue_atom_count)
+    table_index = template_start[sequence_index][residue_index] + atom_offset
+
+    # 0 -> starting unit, 1 -> repeating unit, 2 -> end unit
+    residue_kind = np.ones(residue_count, dtype=np.int16)
+    residue_kind[0] = 0
+    if residue_count > 1:
+        residue_kind[-1] = 2
+
+    polymer = {'atom_name_table': template['atom_name_table'], 
+               'atom_name': template['atom_name'][table_index], 
+               'residue_name_table': get_polymer_residue_name_table(template['residue_name_table']), 
+               'residue_name': template['residue_name'][table_index] + 
+                               residue_kind[residue_index] * len(template['residue_name_table']), 
+               'residue_seq_num': residue_index.astype(np.int32), 
+               'element_table': template['element_table'], 
+               'element': template['element'][table_index]}
+
+    # HW3 is removed from all but the last monomer, HA3 from all but the first one
+    is_hw3 = np.zeros(len(template['coord']), dtype=bool)
+    is_ha3 = np.zeros(len(template['coord']), dtype=bool)
+    for start, monomer in zip(template_start, monomer_list):
+        is_hw3[start + monomer['hw3_index']] = True
+        is_ha3[start + monomer['ha3_index']] = True
+    polymer_remove_atom_mask = ((is_hw3[table_index] & (residue_index < max(residue_count - 1, 1))) | 
+                                (is_ha3[table_index] & (residue_index > 0)))
+
+    if seed is not None:
+        polymer['coord'] = grow_random_walk(monomer_list, sequence_index, np.arange(residue_count) == 0, seed)
+        return polymer, polymer_remove_atom_mask
+
+    # step of every residue from the (previous, current) template pair, then chained T_i = T_{i-1} o step_i
+    prev_sequence_index = np.concatenate([[0], sequence_index[:-1]])
+    step_rotation_matrix = np.tile(np.eye(3), (residue_count, 1, 1))
+    step_translation = np.zeros((residue_count, 3))
+    for prev_index, index in set(zip(prev_sequence_index[1:].tolist(), sequence_index[1:].tolist())):
+        pair_residue = np.flatnonzero((prev_sequence_index == prev_index) & (sequence_index == index))
+        pair_residue = pair_residue[pair_residue > 0]
+        step_rotation_matrix[pair_residue], step_translation[pair_residue] = get_pair_transform(monomer_list[prev_index], monomer_list[index])
+    rotation_matrix_list, translation_list = accumulate_transform(step_rotation_matrix, step_translation, np.arange(residue_count) == 0)
+
+    polymer['coord'] = (np.einsum('aij,aj->ai', rotation_matrix_list[residue_index], template['coord'][table_index]) + 
+                        translation_list[residue_index])
+
+    return polymer, polymer_remove_atom_mask
+
+def calc_copolymer_molecular_weight(monomer_list: list, sequence_index: np.array, element_mass_dict: dict = None) -> float:
+    atom_mass_list = [get_atom_mass(monomer, element_mass_dict) for monomer in monomer_list]
+    monomer_mass = np.array([atom_mass.sum() for atom_mass in atom_mass_list])
+    hw3_mass = np.array([atom_mass[monomer['hw3_index']].sum() for monomer, atom_mass in zip(monomer_list, atom_mass_list)])
+    ha3_mass = np.array([atom_mass[monomer['ha3_index']].sum() for monomer, atom_mass in zip(monomer_list, atom_mass_list)])
+
+    # HW3 of all but the last monomer (at least one), HA3 of all but the first one
+    sequence_index = np.asarray(sequence_index)
+    return float(monomer_mass[sequence_index].sum() - 
+                 hw3_mass[sequence_index[:max(len(sequence_index) - 1, 1)]].sum() - 
+                 ha3_mass[sequence_index[1:]].sum())
+
+# Melt density estimate
+'''
+Group-contribution estimate following Slonimskii and Askadskii: every atom contributes its Bondi van der
+Waals sphere minus the caps cut off by its bonded neighbours, and the melt density is the repeat-unit mass
+over the repeat-unit van der Waals volume times the average packing coefficient of amorphous polymers.
+The repeat unit is the middle residue of a trimer, so the caps at both junctions come from real C-C bonds.
+'''
+vdw_radius_dict = {'H': 1.20, 'C': 1.70, 'N': 1.55, 'O': 1.52, 'F': 1.47, 'Si': 2.10, 'P': 1.80, 'S': 1.80, 'Cl': 1.75, 'Br': 1.85}  # Angstrom
+covalent_radius_dict = {'H': 0.31, 'C': 0.76, 'N': 0.71, 'O': 0.66, 'F': 0.57, 'Si': 1.11, 'P': 1.07, 'S': 1.05, 'Cl': 1.02, 'Br': 1.20}  # Angstrom
+bond_tolerance = 0.4  # Angstrom
+packing_coefficient = 0.681
+avogadro_number = 6.02214076e23
+
+def get_bond_index(structure: dict) -> tuple:
+    # bonded pairs (i < j) from covalent radii, small structures only
+    covalent_radius = np.array([covalent_radius_dict[element] for element in structure['element_table']])[structure['element']]
+    distance = np.linalg.norm(structure['coord'][:, None, :] - structure['coord'][None, :, :], axis=-1)
+    bonded = distance < covalent_radius[:, None] + covalent_radius[None, :] + bond_tolerance
+    return np.nonzero(np.triu(bonded, k=1))
+
+def get_atom_vdw_volume(structure: dict) -> np.array:
+    vdw_radius = np.array([vdw_radius_dict[element] for element in structure['element_table']])[structure['element']]
+    volume = 4.0 / 3.0 * np.pi * vdw_radius**3
+
+    # cap of sphere i behind the plane where it meets sphere j, and the other way round
+    iatom, jatom = get_bond_index(structure)
+    distance = np.linalg.norm(structure['coord'][iatom] - structure['coord'][jatom], axis=-1)
+    for atom, other in [(iatom, jatom), (jatom, iatom)]:
+        radius, other_radius = vdw_radius[atom], vdw_radius[other]
+        height = radius - (radius**2 + distance**2 - other_radius**2) / (2.0 * distance)
+        np.subtract.at(volume, atom, np.pi * height**2 * (3.0 * radius - height) / 3.0)
+    return volume
+
+def calc_melt_density(monomer: dict, element_mass_dict: dict = None) -> float:
+    # g/cm3
+    polymer, polymer_remove_atom_mask = build_polymer_structure(monomer, 3)
+    polymer = select_structure(polymer, np.flatnonzero(~polymer_remove_atom_mask))
+    repeat_unit_mask = polymer['residue_seq_num'] == 1
+
+    repeat_unit_volume = get_atom_vdw_volume(polymer)[repeat_unit_mask].sum() * 1e-24  # cm3
+    repeat_unit_mass = get_atom_mass(polymer, element_mass_dict)[repeat_unit_mask].sum() / avogadro_number  # g
+    return float(packing_coefficient * repeat_unit_mass / repeat_unit_volume)
+
+@calcfunction
+def get_melt_density(monomer: SinglefileData, polymer_connection_point_list: List) -> Float:
+    monomer = get_monomer_template(monomer.get_content(), polymer_connection_point_list.get_list())
+    return Float(calc_melt_density(monomer))
+
+def get_rigid_transform(coord: np.array, target_coord: np.array) -> tuple:
+    # Kabsch fit: rotation_matrix @ coord + translation ~ target_coord
+    center = coord.mean(axis=0)
+    target_center = target_coord.mean(axis=0)
+    u, _, vt = np.linalg.svd((coord - center).T @ (target_coord - target_center))
+    sign = np.sign(np.linalg.det(vt.T @ u.T))
+    rotation_matrix = vt.T @ np.diag([1.0, 1.0, sign]) @ u.T
+    return rotation_matrix, target_center - rotation_matrix @ center
+
+def get_skeleton_layout(polymer: dict, monomer: dict, monomer_count: int) -> tuple:
+    # (skeleton, remove mask) of monomer_count monomers with the kept atoms at the coordinates of polymer
+    skeleton, skeleton_remove_atom_mask = get_polymer_skeleton(monomer, monomer_count)
+    monomer_atom_index_dict = {atom_name: iatom for iatom, atom_name in enumerate(monomer['atom_name_table'][monomer['atom_name']])}
+    atom_name_index = np.array([monomer_atom_index_dict.get(atom_name, -1) for atom_name in polymer['atom_name_table']])[polymer['atom_name']]
+    atom_index = polymer['residue_seq_num'] * get_atom_count(monomer) + atom_name_index
+    if np.any(atom_name_index < 0) or not np.array_equal(np.sort(atom_index), np.flatnonzero(~skeleton_remove_atom_mask)):
+        raise ValueError(f'Atoms of the polymer do not match a chain of {monomer_count} monomers.')
+    skeleton['coord'][skeleton_remove_atom_mask] = np.nan  # removed atoms have no place in a grown chain
+    skeleton['coord'][atom_index] = polymer['coord']
+    return skeleton, skeleton_remove_atom_mask
+
+def get_residue_transform(polymer: dict, monomer: dict, iresidue: int) -> tuple:
+    # rigid transform of one residue, fitted from its atoms to the monomer template
+    residue_index = np.flatnonzero(polymer['residue_seq_num'] == iresidue)
+    monomer_atom_name_list = monomer['atom_name_table'][monomer['atom_name']].tolist()
+    residue_atom_name = polymer['atom_name_table'][polymer['atom_name'][residue_index]]
+    monomer_index = np.array([monomer_atom_name_list.index(atom_name) for atom_name in residue_atom_name])
+    return get_rigid_transform(monomer['coord'][monomer_index], polymer['coord'][residue_index])
+
+def get_link_torsion_angle(monomer: dict, prev_transform: tuple, transform: tuple) -> float:
+    # torsion of the link between two placed residues, as drawn by grow_random_walk
+    torsion_axis, _ = get_torsion_axis(monomer)
+    pair_rotation_matrix, _ = get_pair_transform(monomer, monomer)
+    torsion_matrix = prev_transform[0].T @ transform[0] @ pair_rotation_matrix.T
+    sin_angle = torsion_axis @ np.array([torsion_matrix[2, 1] - torsion_matrix[1, 2], 
+                                         torsion_matrix[0, 2] - torsion_matrix[2, 0], 
+                                         torsion_matrix[1, 0] - torsion_matrix[0, 1]]) / 2.0
+    return float(np.arctan2(sin_angle, (np.trace(torsion_matrix) - 1.0) / 2.0))
+
+def extend_polymer_structure(polymer: dict, monomer: dict, monomer_count: int, build_mode: str = 'stepwise', seed: int = 0) -> tuple:
+    '''
+    Append monomers to an existing chain (kept atoms only, e.g. a previous polymer.pdb) up to monomer_count.
+    Returns the longer chain laid out like build_polymer_structure, so both keep the same atoms and atom serials.
+    '''
+    prev_monomer_count = int(polymer['residue_seq_num'].max()) + 1
+    if prev_monomer_count > monomer_count:
+        raise ValueError(f'Polymer already has {prev_monomer_count} monomers, more than {monomer_count}.')
+    elif prev_monomer_count == monomer_count:
+        return get_skeleton_layout(polymer, monomer, monomer_count)
+
+    # a fresh chain grows from the anchor residue, which keeps its place; a random walk anchors one residue
+    # before the old end, so that the link torsion of the old end can be redrawn when no new monomer fits after it
+    anchor_residue = prev_monomer_count - 2 if build_mode == 'random_walk' and prev_monomer_count > 1 else prev_monomer_count - 1
+    rotation_matrix, translation = get_residue_transform(polymer, monomer, anchor_residue)
+    extension_count = monomer_count - anchor_residue
+    if build_mode == 'random_walk':
+        # the existing atoms before the anchor seed the cell list, so the new monomers avoid them
+        extension, extension_remove_atom_mask = get_polymer_skeleton(monomer, extension_count)
+        link_atom_name = monomer['atom_name_table'][monomer['atom_name'][np.concatenate([monomer['hw3_index'], monomer['ha3_index']])]]
+        existing_mask = ((polymer['residue_seq_num'] < anchor_residue) & 
+                         ~np.isin(polymer['atom_name_table'][polymer['atom_name']], link_atom_name))
+        start_torsion_angle = None
+        if anchor_residue < prev_monomer_count - 1:
+            # the first trial puts the old end back where it was
+            start_torsion_angle = get_link_torsion_angle(monomer, (rotation_matrix, translation), 
+                                                         get_residue_transform(polymer, monomer, prev_monomer_count - 1))
+        extension['coord'] = grow_random_walk([monomer], np.zeros(extension_count, dtype=np.int64), np.arange(extension_count) == 0, seed, 
+                                              start_transform=(rotation_matrix, translation), start_coord=polymer['coord'][existing_mask], 
+                                              start_torsion_angle=start_torsion_angle)
+    else:
+        extension, extension_remove_atom_mask = build_polymer_structure(monomer, extension_count, build_mode, seed)
+        extension['coord'] = extension['coord'] @ rotation_matrix.T + translation
+    extension_atom_index = np.flatnonzero(~extension_remove_atom_mask & (extension['residue_seq_num'] > 0))
+    extension = select_structure(extension, extension_atom_index)
+    extension['residue_seq_num'] += anchor_residue
+
+    # the anchor becomes a repeating unit and loses its HW3, the residues after it come from the extension
+    hw3_atom_name = monomer['atom_name_table'][monomer['atom_name'][monomer['hw3_index']]]
+    keep = ((polymer['residue_seq_num'] <= anchor_residue) & 
+            ~((polymer['residue_seq_num'] == anchor_residue) & np.isin(polymer['atom_name_table'][polymer['atom_name']], hw3_atom_name)))
+    polymer = select_structure(polymer, np.flatnonzero(keep))
+    if anchor_residue > 0:
+        anchor_residue_index = np.flatnonzero(polymer['residue_seq_num'] == anchor_residue)
+        residue_name_list = polymer['residue_name_table'][polymer['residue_name'][anchor_residue_index]]
+        for residue_name in np.unique(residue_name_list):
+            set_categorical(polymer, 'residue_name', anchor_residue_index[residue_name_list == residue_name], residue_name[:-1] + '2')
+
+    return get_skeleton_layout(concatenate_structure([polymer, extension]), monomer, monomer_count)
+
 class PolymerizeWorkChain(WorkChain):
 
     @classmethod
@@ -116,152 +723,188 @@ class PolymerizeWorkChain(WorkChain):
         spec.input('monomer', valid_type = SinglefileData)
         spec.input('polymer_connection_point_list', valid_type = List)
         spec.input('monomer_count', valid_type = Int)
+        spec.input('build_mode', valid_type = Str, default = lambda: Str('stepwise'))
+        spec.input('seed', valid_type = Int, default = lambda: Int(0))  # torsions of the random_walk mode
+        spec.input('store_binary', valid_type = Bool, default = lambda: Bool(False))
+        spec.input('use_cache', valid_type = Bool, default = lambda: Bool(False))
+        spec.input('polymer', valid_type = SinglefileData, required = False)
         spec.output('polymer', valid_type = SinglefileData)
+        spec.output('polymer_binary', valid_type = SinglefileData, required = False)
         spec.output('polymer_molecular_weight', valid_type = Float)
         spec.outline(cls.make_polymer, cls.result)
 
     def make_polymer(self):
-        monomer_atom_lines = get_atom_lines(self.inputs.monomer.get_content().split('\n'))
-        monomer_all_atom_list = []
-        for num, line in enumerate(monomer_atom_lines):
-            monomer_all_atom_list.append(get_atom_dict(num, line))
-        
-        polymer_all_atom_list = []
-        polymer_remove_atom_index_list = []
-
-        #['CW', 'HW3', 'HA3', 'CA']
-        cw_atom_name = self.inputs.polymer_connection_point_list.get_list()[0]
-        hw3_atom_name = self.inputs.polymer_connection_point_list.get_list()[1]
-        ha3_atom_name = self.inputs.polymer_connection_point_list.get_list()[2]
-        ca_atom_name = self.inputs.polymer_connection_point_list.get_list()[3]
-        #print(cw_atom_name, hw3_atom_name, ha3_atom_name, ca_atom_name)
-
-        # get the HA3 of model monomer
-        ha3_index = -1
-        for iatom in monomer_all_atom_list:
-            if iatom['atom_name'] == ha3_atom_name:
-                ha3_index = iatom['atom_number']
-                break
-        
-        if ha3_index < 0:
-            raise ValueError('HA3 atom is not found.')
-
-        # get the CA of model monomer
-        ca_index = -1
-        for iatom in monomer_all_atom_list:
-            if iatom['atom_name'] == ca_atom_name:
-                ca_index = iatom['atom_number']
-                break
-
-        if ca_index < 0:
-            raise ValueError('CA atom is not found.')
-
-        # get coordinate of connection point (lies on CA-HA3 vector with a CA-Connection point distance of 1.58)
-        pos1 = np.array(copy.deepcopy(monomer_all_atom_list[ha3_index]['coord']))
-        pos2 = np.array(copy.deepcopy(monomer_all_atom_list[ca_index]['coord']))
-        ca_ha3_unit_vec = get_unit_vector(pos1, pos2)
-        ha3_coord = pos2 + ca_ha3_unit_vec * 1.58
-
-        # Add monomers to the polymer chain
-        polymer_atom_count = 0
-        print(f'Polymerization starts for {self.inputs.monomer.filename} ->')
-        for imonomer in range(self.inputs.monomer_count.value):
-            print(imonomer+1, end='\r')
-            #print('Start ', imonomer)
-            monomer_atom_count = len(monomer_all_atom_list)
-            # first monomer
-            if imonomer == 0:
-                for iatom in monomer_all_atom_list:
-                    curratom = copy_atomdict(iatom)
-                    curratom = update_atom_number(curratom, polymer_atom_count)
-                    curratom = update_residue_seq_num(curratom, imonomer)
-                    
-                    polymer_all_atom_list.append(curratom)
-                    
-                    if iatom['atom_name'] == hw3_atom_name:
-                        polymer_remove_atom_index_list.append(polymer_all_atom_list[len(polymer_all_atom_list)-1]['atom_number'])
-                    polymer_atom_count += 1
-            else:
-                # get the CW of last monomer
-                cw_index = -1
-                for iatom in polymer_all_atom_list:
-                    if iatom['atom_name'] == cw_atom_name:
-                        cw_index = iatom['atom_number']
-
-                if cw_index < 0:
-                    raise ValueError('CW atom is not found.')
-
-                dtranslate = np.array(polymer_all_atom_list[cw_index]['coord']) - ha3_coord
-
-                # put the next monomer in the polymer + translation
-                for iatom in monomer_all_atom_list:
-                    curratom = copy_atomdict(iatom)
-                    curratom = update_atom_number(curratom, polymer_atom_count)
-                    curratom = update_residue_seq_num(curratom, imonomer)
-
-                    coord = np.array(iatom['coord']) + dtranslate
-                    curratom = update_coord(curratom, coord)
-
-                    if imonomer != self.inputs.monomer_count.value - 1:
-                        curratom = update_residue_name(curratom, iatom['residue_name'][:-1] + '2')
-                    else:
-                        curratom = update_residue_name(curratom, iatom['residue_name'][:-1] + '3')
-            
-                    polymer_all_atom_list.append(curratom)
-
-                    if polymer_all_atom_list[len(polymer_all_atom_list)-1]['atom_name'] == ha3_atom_name:
-                        polymer_remove_atom_index_list.append(polymer_all_atom_list[len(polymer_all_atom_list)-1]['atom_number'])
-                    elif polymer_all_atom_list[len(polymer_all_atom_list)-1]['atom_name'] == hw3_atom_name:
-                        if polymer_all_atom_list[len(polymer_all_atom_list)-1]['residue_seq_num'] != self.inputs.monomer_count.value - 1:
-                            polymer_remove_atom_index_list.append(polymer_all_atom_list[len(polymer_all_atom_list)-1]['atom_number'])
-                    
-                    polymer_atom_count += 1
-
-                # rotation starts here
-                # CW.coord == HA3.coord
-                # get the CA of last monomer and HW3 of previous monomer
-                ca_index = -1
-                hw3_index = -1
-                for iatom in polymer_all_atom_list:
-                    if iatom['atom_name'] == ca_atom_name:
-                        ca_index = iatom['atom_number']
-                    if iatom['atom_name'] == hw3_atom_name and iatom['residue_seq_num'] == imonomer - 1:
-                        hw3_index = iatom['atom_number']
-                        
-                if ca_index < 0:
-                    raise ValueError('CA atom is not found.')
-
-                pos1 = np.array(copy.deepcopy(polymer_all_atom_list[hw3_index]['coord']))
-                pos2 = np.array(copy.deepcopy(polymer_all_atom_list[cw_index]['coord']))
-                cw_hw3_unit_vec = get_unit_vector(pos1, pos2)
-
-                pos1 = np.array(copy.deepcopy(polymer_all_atom_list[ca_index]['coord']))
-                cw_ca_unit_vec = get_unit_vector(pos1, pos2)
-                
-                rotation_matrix = get_rotation_matrix(cw_hw3_unit_vec, cw_ca_unit_vec)
-
-                for index, iatom in enumerate(polymer_all_atom_list):
-                    if iatom['residue_seq_num'] == imonomer and iatom['atom_name'] != '':
-                        pos1 = np.array(copy.deepcopy(iatom['coord']))
-                        coord = rotate_coord(pos1, pos2, rotation_matrix).tolist()
-                        polymer_all_atom_list[index] = update_coord(polymer_all_atom_list[index], coord)
-            #print('Done ', imonomer)
-        polymer_all_atom_lines = []
-        
-        self.ctx.polymer_molecular_weight = Float(0.0)
-        dataframe_elements = pd.read_csv(os.getcwd() + '/elements.csv', index_col = None)
-
-        print('')
-        #print('remove = ', polymer_remove_atom_index_list.get_list())
-        for iatom in polymer_all_atom_list:
-            if iatom['atom_number'] not in polymer_remove_atom_index_list:
-                self.ctx.polymer_molecular_weight += \
-                Float(dataframe_elements.loc[dataframe_elements['Symbol'] == \
-                      iatom['element'], 'AtomicMass'].iloc[0])
-                polymer_all_atom_lines.append(get_pdbstr(iatom))
-                #print(get_pdbstr(iatom))
-        self.ctx.polymer = SinglefileData.from_string('\n'.join(polymer_all_atom_lines), filename='polymer.pdb')
+        monomer_content = self.inputs.monomer.get_content()
+        polymer_connection_point_list = self.inputs.polymer_connection_point_list.get_list()
+        monomer_count = self.inputs.monomer_count.value
+        build_mode = self.inputs.build_mode.value
+        seed = self.inputs.seed.value
+        # a chain extended from a given polymer depends on it, only chains built from scratch go through the cache
+        use_cache = self.inputs.use_cache.value and 'polymer' not in self.inputs
+
+        if use_cache:
+            # random walk chains differ per seed
+            cache_build_mode = f'{build_mode}:{seed}' if build_mode == 'random_walk' else build_mode
+            self.ctx.cache_key = get_cache_key(monomer_content, polymer_connection_point_list, monomer_count, cache_build_mode)
+            cache_entry = get_cached_polymer(self.ctx.cache_key)
+            if cache_entry is not None:
+                print(f'Polymer for {self.inputs.monomer.filename} is loaded from the cache.')
+                self.ctx.polymer = get_cached_polymer_node(self.ctx.cache_key, cache_entry)
+                self.ctx.polymer_molecular_weight = Float(cache_entry['polymer_molecular_weight'])
+                if self.inputs.store_binary.value:
+                    self.ctx.polymer_binary = get_cached_polymer_binary(self.ctx.cache_key, cache_entry)
+                    if not self.ctx.polymer_binary.is_stored:
+                        # the first hit that asks for the binary stores it, later hits return that node
+                        self.ctx.polymer_binary.store()
+                        set_cached_polymer_binary_uuid(self.ctx.cache_key, self.ctx.polymer_binary.uuid)
+                return
+
+        # start from a shorter chain if one is given, a miss in the cache builds from scratch
+        prev_polymer = None
+        if 'polymer' in self.inputs:
+            prev_polymer = read_structure_singlefile(self.inputs.polymer)
+
+        monomer = get_monomer_template(monomer_content, polymer_connection_point_list)
+
+        if prev_polymer is None:
+            print(f'Polymerization starts for {self.inputs.monomer.filename} ->')
+            polymer, polymer_remove_atom_mask = build_polymer_structure(monomer, monomer_count, build_mode, seed)
+        else:
+            print(f'Polymerization continues for {self.inputs.monomer.filename} from {prev_polymer["residue_seq_num"].max() + 1} monomers ->')
+            polymer, polymer_remove_atom_mask = extend_polymer_structure(prev_polymer, monomer, monomer_count, build_mode, seed)
+        polymer_atom_index = np.flatnonzero(~polymer_remove_atom_mask)
+        self.ctx.polymer_molecular_weight = Float(calc_polymer_molecular_weight(monomer, monomer_count))
+
+        self.ctx.polymer = get_structure_singlefile(polymer, 'polymer.pdb', polymer_atom_index)
+        if self.inputs.store_binary.value:
+            # memory-mappable copy of the same atoms for downstream analysis
+            self.ctx.polymer_binary = get_structure_singlefile(polymer, 'polymer.bin', polymer_atom_index)
+
+        if use_cache:
+            # the nodes are stored now so later hits can return them instead of new files
+            self.ctx.polymer.store()
+            if 'polymer_binary' in self.ctx:
+                self.ctx.polymer_binary.store()
+            store_cached_polymer(self.ctx.cache_key, 
+                                 select_structure(polymer, polymer_atom_index), 
+                                 self.ctx.polymer_molecular_weight.value, 
+                                 self.ctx.polymer.uuid, 
+                                 self.ctx.polymer_binary.uuid if 'polymer_binary' in self.ctx else None, 
+                                 monomer_count)
+
+    def result(self):
+        self.out('polymer', self.ctx.polymer)
+        if 'polymer_binary' in self.ctx:
+            self.out('polymer_binary', self.ctx.polymer_binary)
+        self.out('polymer_molecular_weight', self.ctx.polymer_molecular_weight)
+
+class PolymerizeBatchWorkChain(WorkChain):
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.input('monomer', valid_type = SinglefileData)
+        spec.input('polymer_connection_point_list', valid_type = List)
+        spec.input('monomer_count', valid_type = Int)  # number-average
+        spec.input('chain_count', valid_type = Int)
+        spec.input('chain_length_distribution', valid_type = Str, default = lambda: Str('monodisperse'))
+        spec.input('dispersity', valid_type = Float, default = lambda: Float(2.0))
+        spec.input('seed', valid_type = Int, default = lambda: Int(0))  # chain lengths and random_walk torsions
+        spec.input('build_mode', valid_type = Str, default = lambda: Str('stepwise'))
+        spec.input('store_binary', valid_type = Bool, default = lambda: Bool(False))
+        spec.output('polymer', valid_type = SinglefileData)
+        spec.output('polymer_binary', valid_type = SinglefileData, required = False)
+        spec.output('chain_length_list', valid_type = List)
+        spec.output('polymer_molecular_weight_list', valid_type = List)
+        spec.output('polymer_molecular_weight', valid_type = Float)  # sum over chains
+        spec.outline(cls.make_polymer, cls.result)
+
+    def make_polymer(self):
+        monomer = get_monomer_template(self.inputs.monomer.get_content(), self.inputs.polymer_connection_point_list.get_list())
+        chain_length_list = get_chain_length_list(self.inputs.chain_count.value, 
+                                                  self.inputs.monomer_count.value, 
+                                                  self.inputs.chain_length_distribution.value, 
+                                                  self.inputs.dispersity.value, 
+                                                  self.inputs.seed.value)
+
+        print(f'Polymerization starts for {len(chain_length_list)} chains of {self.inputs.monomer.filename} ->')
+        polymer, polymer_remove_atom_mask = build_polymer_batch(monomer, chain_length_list, self.inputs.build_mode.value, 
+                                                                seed=self.inputs.seed.value)
+        polymer_atom_index = np.flatnonzero(~polymer_remove_atom_mask)
+
+        polymer_molecular_weight_list = calc_polymer_molecular_weight(monomer, chain_length_list)
+        self.ctx.chain_length_list = List(chain_length_list.tolist())
+        self.ctx.polymer_molecular_weight_list = List(polymer_molecular_weight_list.tolist())
+        self.ctx.polymer_molecular_weight = Float(polymer_molecular_weight_list.sum())
+
+        self.ctx.polymer = get_structure_singlefile(polymer, 'polymer.pdb', polymer_atom_index)
+        if self.inputs.store_binary.value:
+            self.ctx.polymer_binary = get_structure_singlefile(polymer, 'polymer.bin', polymer_atom_index)
+
+    def result(self):
+        self.out('polymer', self.ctx.polymer)
+        if 'polymer_binary' in self.ctx:
+            self.out('polymer_binary', self.ctx.polymer_binary)
+        self.out('chain_length_list', self.ctx.chain_length_list)
+        self.out('polymer_molecular_weight_list', self.ctx.polymer_molecular_weight_list)
+        self.out('polymer_molecular_weight', self.ctx.polymer_molecular_weight)
+
+class CopolymerizeWorkChain(WorkChain):
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.input('monomer_id_list', valid_type = List)  # keys of polymer_constant.get_pdb, the sequence itself if explicit
+        spec.input('monomer_count', valid_type = Int, required = False)
+        spec.input('sequence_type', valid_type = Str, default = lambda: Str('block'))
+        spec.input('ratio', valid_type = List, required = False)
+        spec.input('seed', valid_type = Int, default = lambda: Int(0))
+        spec.input('random_walk', valid_type = Bool, default = lambda: Bool(False))
+        spec.input('store_binary', valid_type = Bool, default = lambda: Bool(False))
+        spec.output('polymer', valid_type = SinglefileData)
+        spec.output('polymer_binary', valid_type = SinglefileData, required = False)
+        spec.output('sequence', valid_type = List)
+        spec.output('polymer_molecular_weight', valid_type = Float)
+        spec.exit_code(300, 'ERROR_MISSING_MONOMER_COUNT', message = 'Sequence type {sequence_type} needs a monomer_count.')
+        spec.exit_code(301, 'ERROR_ALTERNATING_RATIO', message = 'An alternating sequence has equal numbers of every monomer, ratio {ratio} is not equal.')
+        spec.outline(cls.check_inputs, cls.make_polymer, cls.result)
+
+    def check_inputs(self):
+        sequence_type = self.inputs.sequence_type.value
+        if sequence_type != 'explicit' and 'monomer_count' not in self.inputs:
+            return self.exit_codes.ERROR_MISSING_MONOMER_COUNT.format(sequence_type = sequence_type)
+        if sequence_type == 'alternating' and 'ratio' in self.inputs and len(set(self.inputs.ratio.get_list())) > 1:
+            return self.exit_codes.ERROR_ALTERNATING_RATIO.format(ratio = self.inputs.ratio.get_list())
+
+    def make_polymer(self):
+        sequence = get_copolymer_sequence([int(monomer_id) for monomer_id in self.inputs.monomer_id_list.get_list()], 
+                                          self.inputs.monomer_count.value if 'monomer_count' in self.inputs else None, 
+                                          self.inputs.sequence_type.value, 
+                                          self.inputs.ratio.get_list() if 'ratio' in self.inputs else None, 
+                                          self.inputs.seed.value)
+        monomer_id_list, sequence_index = np.unique(sequence, return_inverse=True)
+
+        monomer_list = []
+        for monomer_id in monomer_id_list:
+            if f'{monomer_id}' not in pdb_dict:
+                raise ValueError(f'Monomer {monomer_id} is not in the current database.')
+            with open(os.path.join(monomer_data_dir, pdb_dict[f'{monomer_id}'])) as handle:
+                monomer_list.append(get_monomer_template(handle.read(), connection_point_dict[f'{monomer_id}']))
+
+        print(f'Copolymerization starts for {", ".join(pdb_dict[f"{monomer_id}"] for monomer_id in monomer_id_list)} ->')
+        seed = self.inputs.seed.value if self.inputs.random_walk.value else None
+        polymer, polymer_remove_atom_mask = build_copolymer_structure(monomer_list, sequence_index, seed)
+        polymer_atom_index = np.flatnonzero(~polymer_remove_atom_mask)
+
+        self.ctx.sequence = List(sequence.tolist())
+        self.ctx.polymer_molecular_weight = Float(calc_copolymer_molecular_weight(monomer_list, sequence_index))
+        self.ctx.polymer = get_structure_singlefile(polymer, 'polymer.pdb', polymer_atom_index)
+        if self.inputs.store_binary.value:
+            self.ctx.polymer_binary = get_structure_singlefile(polymer, 'polymer.bin', polymer_atom_index)
 
     def result(self):
         self.out('polymer', self.ctx.polymer)
+        if 'polymer_binary' in self.ctx:
+            self.out('polymer_binary', self.ctx.polymer_binary)
+        self.out('sequence', self.ctx.sequence)
         self.out('polymer_molecular_weight', self.ctx.polymer_molecular_weight)
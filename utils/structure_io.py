@@ -0,0 +1,362 @@
+import itertools
+import tempfile
+import json
+import numpy as np
+
+from aiida.orm import SinglefileData
+
+pdb_atom_fmt = 'ATOM  %5s %-4s %3s  %4s    %8.3f%8.3f%8.3f                      %2s'
+gro_atom_fmt = '%5d%-5s%5s%5d%8.3f%8.3f%8.3f'
+pdb_cryst1_fmt = 'CRYST1%9.3f%9.3f%9.3f  90.00  90.00  90.00 P 1           1'
+# coordinates that fit the %8.3f columns of both text formats (Angstrom for .pdb, nm for .gro)
+text_coord_range = (-999.999, 9999.999)
+
+# binary layout: magic, header length (uint64), json header, then 64 byte aligned raw arrays
+binary_magic = b'AQESTRC1'
+binary_alignment = 64
+
+hybrid36_digit_upper = np.frombuffer(b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ', dtype=np.uint8)
+hybrid36_digit_lower = np.frombuffer(b'0123456789abcdefghijklmnopqrstuvwxyz', dtype=np.uint8)
+
+def get_categorical(values) -> tuple:
+    values = np.asarray(values)
+    if values.dtype.kind == 'S' and values.dtype.itemsize in (1, 2, 4, 8):
+        # sort fixed-width byte columns as integers, which is much faster than comparing strings
+        table, codes = np.unique(np.ascontiguousarray(values).view(f'u{values.dtype.itemsize}'), return_inverse=True)
+        table = table.view(values.dtype)
+    else:
+        table, codes = np.unique(values, return_inverse=True)
+    if table.dtype.kind == 'S':
+        # raw fixed-width columns: strip the padding and merge names that only differed in it
+        table, inverse = np.unique(np.char.strip(table).astype(str), return_inverse=True)
+        codes = inverse[codes]
+    return table, codes.astype(np.int16)
+
+def get_structure(atom_name, residue_name, residue_seq_num, coord, element) -> dict:
+    atom_name_table, atom_name_code = get_categorical(atom_name)
+    residue_name_table, residue_name_code = get_categorical(residue_name)
+    element_table, element_code = get_categorical(element)
+    return {'atom_name_table': atom_name_table, 
+            'atom_name': atom_name_code, 
+            'residue_name_table': residue_name_table, 
+            'residue_name': residue_name_code, 
+            'residue_seq_num': np.asarray(residue_seq_num, dtype=np.int32), 
+            'coord': np.asarray(coord, dtype=np.float64).reshape(-1, 3), 
+            'element_table': element_table, 
+            'element': element_code}
+
+def select_structure(structure: dict, atom_index: np.array) -> dict:
+    # per-atom arrays are indexed, lookup tables and the box are shared
+    return {key: value if key.endswith('_table') or key == 'box' else value[atom_index]
+            for key, value in structure.items()}
+
+def concatenate_structure(structure_list: list) -> dict:
+    # merge the lookup tables and remap the codes of every part onto them
+    structure = {}
+    for key in ['atom_name', 'residue_name', 'element']:
+        table = np.unique(np.concatenate([part[f'{key}_table'] for part in structure_list]))
+        structure[f'{key}_table'] = table
+        structure[key] = np.concatenate([np.searchsorted(table, part[f'{key}_table'])[part[key]] 
+                                         for part in structure_list]).astype(np.int16)
+    structure['residue_seq_num'] = np.concatenate([part['residue_seq_num'] for part in structure_list]).astype(np.int32)
+    structure['coord'] = np.concatenate([np.asarray(part['coord'], dtype=np.float64) for part in structure_list])
+    return structure
+
+def set_categorical(structure: dict, key: str, atom_index: np.array, value: str):
+    table = structure[f'{key}_table']
+    code = np.flatnonzero(table == value)
+    if len(code) == 0:
+        structure[f'{key}_table'] = np.append(table, value)
+        code = [len(table)]
+    structure[key][atom_index] = code[0]
+
+def get_hybrid36(values: np.array, width: int) -> np.array:
+    '''
+    Hybrid-36 encoding used by PDB for atom serials (width 5) and residue numbers (width 4):
+    decimal up to 10**width - 1, then A000.. - Z999.., then a000.. - z999..
+    '''
+    values = np.asarray(values, dtype=np.int64)
+    result = values.astype(f'U{width}')
+
+    big = values >= 10**width
+    if not np.any(big):
+        return result
+
+    # offset so that the first value past the decimal range encodes as A000..
+    value = values[big] - 10**width + 10 * 36**(width - 1)
+    upper = value < 36**width
+    value = np.where(upper, value, value - 26 * 36**(width - 1))
+    if np.any(value >= 36**width):
+        raise ValueError(f'Number is too large for hybrid-36 with width {width}.')
+
+    power = 36 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    digit = (value[:, None] // power) % 36
+    char = np.where(upper[:, None], hybrid36_digit_upper[digit], hybrid36_digit_lower[digit])
+    result[big] = np.ascontiguousarray(char, dtype=np.uint8).view(f'S{width}').ravel().astype(f'U{width}')
+
+    return result
+
+def parse_hybrid36(values: np.array, width: int) -> np.array:
+    values = np.char.strip(np.asarray(values))
+    result = np.zeros(len(values), dtype=np.int64)
+
+    decimal = np.char.isdigit(values) | np.char.startswith(values, b'-')
+    if np.any(decimal):
+        result[decimal] = values[decimal].astype(np.int64)
+
+    encoded = ~decimal & (values != b'')
+    if not np.any(encoded):
+        return result
+
+    char = np.frombuffer(np.ascontiguousarray(values[encoded].astype(f'S{width}')), dtype=np.uint8).reshape(-1, width)
+    upper = (char[:, 0] >= ord('A')) & (char[:, 0] <= ord('Z'))
+    digit = np.where(char >= ord('a'), char - ord('a') + 10, 
+                     np.where(char >= ord('A'), char - ord('A') + 10, char - ord('0'))).astype(np.int64)
+    value = digit @ (36 ** np.arange(width - 1, -1, -1, dtype=np.int64))
+    value = value - 10 * 36**(width - 1) + 10**width
+    result[encoded] = np.where(upper, value, value + 26 * 36**(width - 1))
+
+    return result
+
+def get_buffer(content) -> np.array:
+    if isinstance(content, str):
+        content = content.encode()
+    return np.frombuffer(content, dtype=np.uint8)
+
+def read_buffer(fname: str, mmap: bool = False) -> np.array:
+    if mmap:
+        return np.memmap(fname, dtype=np.uint8, mode='r')
+    return np.fromfile(fname, dtype=np.uint8)
+
+def get_line_bounds(buf: np.array) -> tuple:
+    newline = np.flatnonzero(buf == ord('\n'))
+    start = np.concatenate([[0], newline + 1])
+    end = np.concatenate([newline, [len(buf)]])
+    return start, end
+
+def get_fixed_column(buf: np.array, start: np.array, end: np.array, col_start: int, col_end: int) -> np.array:
+    # gather one fixed-width column of every line at once, padding short lines with blanks
+    if len(start) == 0 or len(buf) == 0:
+        return np.zeros(len(start), dtype=f'S{col_end - col_start}')
+
+    stride = start[1] - start[0] if len(start) > 1 else 0
+    if stride > 0 and np.all(np.diff(start) == stride) and np.all(end - start >= col_end):
+        # equally long lines (e.g. GROMACS output): read the column through a strided view
+        line = np.lib.stride_tricks.as_strided(buf[start[0]:], shape=(len(start), col_end), strides=(stride, 1))
+        char = np.ascontiguousarray(line[:, col_start:col_end])
+        char[char == ord('\r')] = ord(' ')
+        return char.view(f'S{col_end - col_start}').ravel()
+
+    index = start[:, None] + np.arange(col_start, col_end)
+    char = buf[np.minimum(index, len(buf) - 1)]
+    char[(index >= end[:, None]) | (char == ord('\r'))] = ord(' ')
+    return np.ascontiguousarray(char).view(f'S{col_end - col_start}').ravel()
+
+def guess_element(atom_name: np.array) -> np.array:
+    # first letter of the atom name (digits such as in 1HB are skipped)
+    atom_name = np.char.lstrip(np.char.strip(atom_name), b'0123456789')
+    return np.char.upper(np.char.ljust(atom_name, 1).astype('S1'))
+
+def parse_pdb(buf: np.array) -> dict:
+    start, end = get_line_bounds(buf)
+    record = get_fixed_column(buf, start, end, 0, 6)
+    atom_line = np.char.startswith(record, b'ATOM') | np.char.startswith(record, b'HETATM')
+    cryst1_start = start[record == b'CRYST1']
+    start, end = start[atom_line], end[atom_line]
+
+    atom_name = get_fixed_column(buf, start, end, 12, 16)
+    element = get_fixed_column(buf, start, end, 76, 78)
+    missing_element = np.char.strip(element) == b''
+    if np.any(missing_element):
+        element[missing_element] = guess_element(atom_name[missing_element])
+
+    coord = np.empty((len(start), 3))
+    for icol, col_start in enumerate([30, 38, 46]):
+        coord[:, icol] = get_fixed_column(buf, start, end, col_start, col_start + 8).astype(np.float64)
+
+    structure = get_structure(atom_name, 
+                              get_fixed_column(buf, start, end, 17, 20), 
+                              parse_hybrid36(get_fixed_column(buf, start, end, 22, 26), 4) - 1, 
+                              coord, 
+                              element)
+    if len(cryst1_start) > 0:
+        line = bytes(buf[cryst1_start[0]:cryst1_start[0] + 33])
+        structure['box'] = np.array([line[6:15], line[15:24], line[24:33]], dtype=np.float64)
+
+    return structure
+
+def parse_gro(buf: np.array) -> dict:
+    start, end = get_line_bounds(buf)
+    atom_count = int(bytes(buf[start[1]:end[1]]))
+    box_start, box_end = start[2 + atom_count], end[2 + atom_count]
+    start, end = start[2:2 + atom_count], end[2:2 + atom_count]
+
+    # coordinate precision is given by the distance between the decimal points
+    first_line = bytes(buf[start[0]:end[0]]) if atom_count > 0 else b''
+    dot = [i for i, char in enumerate(first_line) if i >= 20 and char == ord('.')]
+    width = dot[1] - dot[0] if len(dot) > 1 else 8
+
+    atom_name = get_fixed_column(buf, start, end, 10, 15)
+    coord = np.empty((atom_count, 3))
+    for icol in range(3):
+        col_start = 20 + icol * width
+        coord[:, icol] = get_fixed_column(buf, start, end, col_start, col_start + width).astype(np.float64)
+
+    structure = get_structure(atom_name, 
+                              get_fixed_column(buf, start, end, 5, 10), 
+                              get_fixed_column(buf, start, end, 0, 5).astype(np.int64) - 1, 
+                              coord * 10.0, 
+                              guess_element(atom_name))
+    structure['box'] = np.array(bytes(buf[box_start:box_end]).split()[:3], dtype=np.float64) * 10.0
+
+    return structure
+
+def parse_binary(buf: np.array) -> dict:
+    # arrays are returned as views on buf, so a memory-mapped file is never copied
+    if bytes(buf[:len(binary_magic)]) != binary_magic:
+        raise ValueError('File is not a binary structure.')
+    header_length = int(np.frombuffer(buf[8:16], dtype=np.uint64)[0])
+    header = json.loads(bytes(buf[16:16 + header_length]).decode())
+
+    structure = {key: np.array(table) for key, table in header['tables'].items()}
+    for key, array in header['arrays'].items():
+        dtype = np.dtype(array['dtype'])
+        count = int(np.prod(array['shape']))
+        structure[key] = buf[array['offset']:array['offset'] + count * dtype.itemsize].view(dtype).reshape(array['shape'])
+    return structure
+
+def read_structure(fname: str, mmap: bool = False) -> dict:
+    buf = read_buffer(fname, mmap)
+    if fname.endswith('.bin'):
+        return parse_binary(buf)
+    elif fname.endswith('.gro'):
+        return parse_gro(buf)
+    elif fname.endswith('.pdb'):
+        return parse_pdb(buf)
+    raise ValueError(f'Structure format of {fname} is not supported.')
+
+def read_structure_singlefile(node: SinglefileData) -> dict:
+    buf = get_buffer(node.get_content(mode='rb'))
+    if node.filename.endswith('.bin'):
+        return parse_binary(buf)
+    elif node.filename.endswith('.gro'):
+        return parse_gro(buf)
+    elif node.filename.endswith('.pdb'):
+        return parse_pdb(buf)
+    raise ValueError(f'Structure format of {node.filename} is not supported.')
+
+def get_column(structure: dict, key: str, atom_index: np.array) -> np.array:
+    # resolve a categorical column (codes + table) for the selected atoms
+    return structure[f'{key}_table'][structure[key][atom_index]]
+
+def format_rows(row_fmt: str, columns: list) -> str:
+    # one % operation over the whole chunk instead of one per atom
+    row_count = len(columns[0])
+    values = tuple(itertools.chain.from_iterable(zip(*[column.tolist() for column in columns])))
+    return '\n'.join([row_fmt] * row_count) % values
+
+def check_text_coord_range(coord: np.array, fname_ext: str, scale: float = 1.0):
+    # a wider number would shift the columns after it and the file could not be read back
+    if len(coord) == 0:
+        return
+    coord_min, coord_max = coord.min() * scale, coord.max() * scale
+    if coord_min < text_coord_range[0] or coord_max > text_coord_range[1]:
+        raise ValueError(f'Coordinates from {coord_min:.3f} to {coord_max:.3f} do not fit the {fname_ext} format '
+                         f'({text_coord_range[0]} to {text_coord_range[1]}), write a .bin file instead.')
+
+def iter_pdb_chunks(structure: dict, atom_index: np.array = None, chunk_size: int = 100000, box: np.array = None):
+    atom_index = np.arange(len(structure['coord'])) if atom_index is None else np.asarray(atom_index)
+    check_text_coord_range(structure['coord'][atom_index], '.pdb')
+    if box is not None:
+        yield pdb_cryst1_fmt % tuple(np.broadcast_to(box, (3,)))
+    for start in range(0, len(atom_index), chunk_size):
+        index = atom_index[start:start + chunk_size]
+        coord = structure['coord'][index]
+        yield format_rows(pdb_atom_fmt, [get_hybrid36(index + 1, 5),
+                                         get_column(structure, 'atom_name', index),
+                                         get_column(structure, 'residue_name', index),
+                                         get_hybrid36(structure['residue_seq_num'][index] + 1, 4),
+                                         coord[:, 0],
+                                         coord[:, 1],
+                                         coord[:, 2],
+                                         get_column(structure, 'element', index)])
+
+def iter_gro_chunks(structure: dict, atom_index: np.array = None, box: np.array = None, title: str = 'Polymer', chunk_size: int = 100000):
+    atom_index = np.arange(len(structure['coord'])) if atom_index is None else np.asarray(atom_index)
+    check_text_coord_range(structure['coord'][atom_index], '.gro', 0.1)
+
+    # .gro is in nm and wraps atom/residue numbers at 100000
+    yield f'{title}\n{len(atom_index):5d}'
+    for start in range(0, len(atom_index), chunk_size):
+        index = atom_index[start:start + chunk_size]
+        coord = structure['coord'][index] / 10.0
+        yield format_rows(gro_atom_fmt, [(structure['residue_seq_num'][index] + 1) % 100000,
+                                         get_column(structure, 'residue_name', index),
+                                         get_column(structure, 'atom_name', index),
+                                         (start + np.arange(len(index)) + 1) % 100000,
+                                         coord[:, 0],
+                                         coord[:, 1],
+                                         coord[:, 2]])
+
+    box = box if box is not None else structure.get('box')
+    if box is None:
+        coord = structure['coord'][atom_index]
+        box = coord.max(axis=0) - coord.min(axis=0) if len(atom_index) > 0 else np.zeros(3)
+    yield '%10.5f%10.5f%10.5f\n' % tuple(np.asarray(box) / 10.0)
+
+def write_chunks(handle, chunks):
+    for ichunk, chunk in enumerate(chunks):
+        if ichunk > 0:
+            handle.write(b'\n')
+        handle.write(chunk.encode())
+
+def write_pdb(handle, structure: dict, atom_index: np.array = None, chunk_size: int = 100000, box: np.array = None):
+    write_chunks(handle, iter_pdb_chunks(structure, atom_index, chunk_size, box))
+
+def write_gro(handle, structure: dict, atom_index: np.array = None, box: np.array = None, title: str = 'Polymer', chunk_size: int = 100000):
+    write_chunks(handle, iter_gro_chunks(structure, atom_index, box, title, chunk_size))
+
+def write_binary(handle, structure: dict, coord_dtype = np.float32):
+    arrays = {}
+    tables = {}
+    for key, value in structure.items():
+        if key.endswith('_table'):
+            tables[key] = np.asarray(value).tolist()
+        elif isinstance(value, np.ndarray):
+            arrays[key] = np.ascontiguousarray(value, dtype=coord_dtype if key == 'coord' else value.dtype)
+
+    # offsets depend on the header length, so lay out the header until it is stable
+    header = {'tables': tables, 'arrays': {}}
+    header_bytes = b''
+    while True:
+        offset = -(-(16 + len(header_bytes)) // binary_alignment) * binary_alignment
+        for key, value in arrays.items():
+            header['arrays'][key] = {'dtype': value.dtype.str, 'shape': list(value.shape), 'offset': offset}
+            offset += -(-value.nbytes // binary_alignment) * binary_alignment
+        new_header_bytes = json.dumps(header).encode()
+        if len(new_header_bytes) == len(header_bytes):
+            break
+        header_bytes = new_header_bytes
+
+    handle.write(binary_magic)
+    handle.write(np.uint64(len(header_bytes)).tobytes())
+    handle.write(header_bytes)
+    position = 16 + len(header_bytes)
+    for key, value in arrays.items():
+        handle.write(b'\0' * (header['arrays'][key]['offset'] - position))
+        handle.write(memoryview(value).cast('B'))
+        position = header['arrays'][key]['offset'] + value.nbytes
+
+def get_structure_singlefile(structure: dict, filename: str, atom_index: np.array = None, box: np.array = None) -> SinglefileData:
+    # stream the text through a temporary file so only one chunk is held in memory
+    with tempfile.TemporaryFile() as handle:
+        if filename.endswith('.bin'):
+            write_binary(handle, structure if atom_index is None else select_structure(structure, atom_index))
+        elif filename.endswith('.gro'):
+            write_gro(handle, structure, atom_index, box)
+        elif filename.endswith('.pdb'):
+            write_pdb(handle, structure, atom_index, box=box)
+        else:
+            raise ValueError(f'Structure format of {filename} is not supported.')
+        handle.seek(0)
+        return SinglefileData(handle, filename=filename)
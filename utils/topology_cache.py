@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+from aiida.orm import List, SinglefileData, load_node
+from aiida.common.exceptions import NotExistent
+
+from utils.polymer_cache import read_cache_index, write_cache_index
+from utils.gromacs_setup import get_top
+
+# Persistent library of parametrized single chains
+'''
+Every entry is keyed by a hash of the monomer file content, the connection points, the number of monomers,
+the molecule name used in the .itp, the temperature of the single-chain equilibration, and the build mode, seed
+and content of the polymer structure the chain was equilibrated from, so that a random-walk chain never gets
+the conformer of a stepwise one. It keeps the .itp,
+the position restraint file and the equilibrated single-chain structure in a directory of its own, next to
+an index with the uuids of the nodes they were first stored as and the time of last access, which is used
+for LRU eviction once the library grows above its size limit. A blend of already seen components then only
+needs get_top and the insertion of the cached chains.
+'''
+default_cache_dir = os.environ.get('AQE_TOPOLOGY_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'aqe_gromacs_topologies'))
+default_max_size = 2 * 1024**3  # bytes
+topology_file_key_list = ['itp', 'posre', 'structure']
+
+def get_topology_key(monomer_content: bytes, polymer_connection_point_list: list, monomer_count: int,
+                     molecule_name: str, temperature: float = None, build_mode: str = 'stepwise', seed: int = 0,
+                     polymer_content: bytes = None) -> str:
+    if isinstance(monomer_content, str):
+        monomer_content = monomer_content.encode()
+    if isinstance(polymer_content, str):
+        polymer_content = polymer_content.encode()
+    key = hashlib.sha256(monomer_content)
+    key.update(json.dumps([list(polymer_connection_point_list), int(monomer_count), molecule_name,
+                           None if temperature is None else float(temperature), str(build_mode), int(seed),
+                           None if polymer_content is None else hashlib.sha256(polymer_content).hexdigest()]).encode())
+    return key.hexdigest()
+
+def get_topology_dir(key: str, cache_dir: str = default_cache_dir) -> str:
+    return os.path.join(cache_dir, key)
+
+def get_cached_topology(key: str, cache_dir: str = default_cache_dir) -> dict:
+    # entry of a complete library item (all files present), None otherwise
+    index = read_cache_index(cache_dir)
+    entry = index.get(key)
+    if entry is None or set(entry['files']) != set(topology_file_key_list):
+        return None
+    if not all(os.path.exists(os.path.join(get_topology_dir(key, cache_dir), file['filename'])) for file in entry['files'].values()):
+        return None
+
+    entry['last_access'] = time.time()
+    write_cache_index(index, cache_dir)
+    return entry
+
+def get_cached_topology_node(key: str, entry: dict, file_key: str, cache_dir: str = default_cache_dir) -> SinglefileData:
+    # reuse the stored node so that no duplicate repository file is created
+    file = entry['files'][file_key]
+    if file.get('uuid') is not None:
+        try:
+            return load_node(file['uuid'])
+        except NotExistent:
+            pass
+    return SinglefileData(os.path.join(get_topology_dir(key, cache_dir), file['filename']), filename=file['filename'])
+
+def evict_topology_cache(max_size: int = default_max_size, cache_dir: str = default_cache_dir, index: dict = None):
+    index = index if index is not None else read_cache_index(cache_dir)
+    total_size = sum(entry['size'] for entry in index.values())
+    for key in sorted(index, key=lambda key: index[key]['last_access']):
+        if total_size <= max_size:
+            break
+        total_size -= index.pop(key)['size']
+        shutil.rmtree(get_topology_dir(key, cache_dir), ignore_errors=True)
+    write_cache_index(index, cache_dir)
+
+def store_cached_topology(key: str, itp: SinglefileData, posre: SinglefileData, structure: SinglefileData,
+                          monomer_count: int = None, molecule_name: str = None,
+                          cache_dir: str = default_cache_dir, max_size: int = default_max_size):
+    topology_dir = get_topology_dir(key, cache_dir)
+    os.makedirs(topology_dir, exist_ok=True)
+
+    files = {}
+    for file_key, node in zip(topology_file_key_list, [itp, posre, structure]):
+        fname = os.path.join(topology_dir, node.filename)
+        tmp_fname = f'{fname}.{os.getpid()}'
+        with node.open(mode='rb') as source, open(tmp_fname, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.replace(tmp_fname, fname)
+        files[file_key] = {'filename': node.filename, 'uuid': node.uuid if node.is_stored else None}
+
+    index = read_cache_index(cache_dir)
+    index[key] = {'size': sum(os.path.getsize(os.path.join(topology_dir, file['filename'])) for file in files.values()),
+                  'last_access': time.time(),
+                  'files': files,
+                  'monomer_count': None if monomer_count is None else int(monomer_count),
+                  'molecule_name': molecule_name}
+    evict_topology_cache(max_size, cache_dir, index)
+
+def get_cached_top(key_list: list, polymer_count_list: List, cache_dir: str = default_cache_dir) -> tuple:
+    '''
+    topol.top of a system of cached chains, in the order of key_list, and the .itp and posre nodes
+    that grompp needs next to it as {'itp0': ..., 'posre_0': ...}.
+    '''
+    nodes = {}
+    itp_fname_list, posre_fname_list = [], []
+    for ikey, key in enumerate(key_list):
+        entry = get_cached_topology(key, cache_dir)
+        if entry is None:
+            raise Exception(f'ERROR: topology {key} is not in the library')
+        nodes[f'itp{ikey}'] = get_cached_topology_node(key, entry, 'itp', cache_dir)
+        nodes[f'posre_{ikey}'] = get_cached_topology_node(key, entry, 'posre', cache_dir)
+        itp_fname_list.append(entry['files']['itp']['filename'])
+        posre_fname_list.append(entry['files']['posre']['filename'])
+    return get_top(List(itp_fname_list), List(posre_fname_list), polymer_count_list), nodes